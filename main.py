@@ -1,26 +1,50 @@
 import requests
 import os
+import sys
 import re
 import time
 import json
 import random
+import hashlib
+import socket
+import bisect
+import struct
+from array import array
+import base64
+import io
+import shutil
+import glob
+import tempfile
 from tqdm import tqdm
 from bs4 import BeautifulSoup
 from threading import Lock, Thread, Semaphore
 from queue import Queue
+import atexit
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, FIRST_COMPLETED
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
-from collections import defaultdict, Counter
-from urllib.parse import urljoin
+from collections import defaultdict, Counter, deque
+from urllib.parse import urljoin, urlparse, urlencode, parse_qsl, parse_qs, urlunparse
+from email.parser import Parser
+from urllib3 import HTTPResponse
+from requests.structures import CaseInsensitiveDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # ==============================================================================
 # تنظیمات محیطی سرعت/لاگ
 # ==============================================================================
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
-WC_SENDER_WORKERS = int(os.environ.get("WC_SENDER_WORKERS", "6"))
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+PRODUCTS_TREE_FILE = os.environ.get("PRODUCTS_TREE_FILE", "")  # خالی = بدون خروجی درخت محصولات
 SENDER_SLEEP_SEC = float(os.environ.get("SENDER_SLEEP_SEC", "0.05"))
-OUTOFSTOCK_SLEEP_SEC = float(os.environ.get("OUTOFSTOCK_SLEEP_SEC", "0.05"))
 ALT_SKU_LOOKUP = os.environ.get("ALT_SKU_LOOKUP", "false").lower() == "true"
 
 # ==============================================================================
@@ -29,9 +53,93 @@ ALT_SKU_LOOKUP = os.environ.get("ALT_SKU_LOOKUP", "false").lower() == "true"
 logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO),
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-handler = RotatingFileHandler('app.log', maxBytes=1024*1024, backupCount=5, encoding='utf-8')
-handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(handler)
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+logger.propagate = False
+# نوشتن واقعی (stdout و فایل) در رشته جداگانه؛ رشته‌های کاری فقط در صف می‌گذارند
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+handler = RotatingFileHandler('app.log', maxBytes=LOG_FILE_MAX_BYTES, backupCount=5, encoding='utf-8')
+handler.setFormatter(log_formatter)
+log_queue = Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, stream_handler, handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# ==============================================================================
+# پروفایل CPU/حافظه هر مرحله (اختیاری)
+# ==============================================================================
+# PROFILE_STAGES: خالی = خاموش، all = همه مراحل، یا لیست جداشده با کاما (scrape,enrich,...)
+PROFILE_STAGES = {s.strip() for s in os.environ.get("PROFILE_STAGES", "").split(",") if s.strip()}
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "15"))
+PROFILE_RUN_ID = time.strftime("%Y%m%d-%H%M%S")
+
+def _profiling_enabled(name):
+    return "all" in PROFILE_STAGES or name in PROFILE_STAGES
+
+@contextmanager
+def profile_stage(name):
+    # خروجی: <stage>.prof (pstats/snakeviz) و <stage>.tracemalloc (tracemalloc.Snapshot.load)
+    if not _profiling_enabled(name):
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{PROFILE_RUN_ID}-{name}")
+    thread_profilers = []
+    thread_profilers_lock = Lock()
+
+    def _start_thread_profiler(*_):
+        # رشته‌های کاری که داخل مرحله ساخته می‌شوند (جزئیات، دسته‌ها، ارسال گروهی) هم پروفایل می‌شوند
+        prof = cProfile.Profile()
+        with thread_profilers_lock:
+            thread_profilers.append(prof)
+        try:
+            prof.enable()
+        except ValueError:
+            pass
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(25)
+    mem_before = tracemalloc.take_snapshot()
+    profiler = cProfile.Profile()
+    # از پایتون 3.12 پروفایلر روی همه رشته‌ها فعال است
+    per_thread = sys.version_info < (3, 12)
+    if per_thread:
+        threading.setprofile(_start_thread_profiler)
+    t0 = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - t0
+        if per_thread:
+            threading.setprofile(None)
+        mem_after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        stats = pstats.Stats(profiler)
+        with thread_profilers_lock:
+            for prof in thread_profilers:
+                try:
+                    stats.add(prof)
+                except (TypeError, ValueError):
+                    pass
+        stats.dump_stats(f"{base}.prof")
+        mem_after.dump(f"{base}.tracemalloc")
+        top_mem = mem_after.compare_to(mem_before, 'lineno')[:PROFILE_TOP_N]
+        with open(f"{base}.txt", 'w', encoding='utf-8') as f:
+            f.write(f"stage={name} elapsed={elapsed:.3f}s peak_mem={peak / 1048576:.1f}MiB threads={len(thread_profilers)}\n\n")
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+            f.write("\n# tracemalloc (diff vs stage start)\n")
+            for line in top_mem:
+                f.write(f"{line}\n")
+        logger.info(f"🔬 پروفایل مرحله {name}: {elapsed:.2f} ثانیه، اوج حافظه {peak / 1048576:.1f}MiB ← {base}.prof")
 
 # ==============================================================================
 # ثابت‌ها و اطلاعات اتصال
@@ -49,6 +157,209 @@ EWAYS_PASSWORD = os.environ.get("EWAYS_PASSWORD") or "پسورد"
 
 CACHE_FILE = 'products_cache.json'
 
+# ==============================================================================
+# ضبط/بازپخش ترافیک HTTP (کاست) برای اجرای آفلاین و قابل تکرار
+# ==============================================================================
+HTTP_CASSETTE_MODE = os.environ.get("HTTP_CASSETTE_MODE", "").lower()  # record | replay | خالی
+HTTP_CASSETTE_FILE = os.environ.get("HTTP_CASSETTE_FILE", "http_cassette.jsonl")
+HTTP_CASSETTE_LATENCY = os.environ.get("HTTP_CASSETTE_LATENCY", "none").lower()  # none | recorded
+HTTP_CASSETTE_LATENCY_SCALE = float(os.environ.get("HTTP_CASSETTE_LATENCY_SCALE", "1.0"))
+# پارامترهای محرمانه یا متغیر با زمان که در کلید تطبیق حساب نمی‌شوند
+HTTP_CASSETTE_IGNORE_PARAMS = {p.strip() for p in os.environ.get(
+    "HTTP_CASSETTE_IGNORE_PARAMS", "consumer_key,consumer_secret,modified_after").split(",") if p.strip()}
+CASSETTE_SECRET_FIELDS = re.compile(r'pass|token|secret', re.I)
+CASSETTE_SKIP_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length', 'connection'}
+# در بازپخش همه فایل‌های وضعیت به این پوشه می‌روند (خالی = پوشه موقت)؛ فایل‌های واقعی دست نمی‌خورند
+HTTP_CASSETTE_STATE_DIR = os.environ.get("HTTP_CASSETTE_STATE_DIR", "")
+REPLAY_STATE_DIR = None  # در حالت بازپخش پوشه واقعی وضعیت
+# متغیرهای محیطی فایل‌های وضعیت و مقدار پیش‌فرضشان (CACHE_FILE جداگانه جابه‌جا می‌شود)
+CASSETTE_STATE_ENV = {
+    "EWAYS_SESSION_FILE": "eways_session.json",
+    "WC_OUTBOX_FILE": "wc_outbox.json",
+    "PLAN_FILE": "sync_plan.json",
+    "CATEGORY_STATS_FILE": "category_stats.json",
+    "CHANGE_FEED_FILE": "change_feed.jsonl",
+    "PRICE_HISTORY_FILE": "price_history.bin",
+    "ALT_SKU_NEGATIVE_FILE": "alt_sku_negative.json",
+    "RUN_LOCK_FILE": "run.lock",
+    "SHARD_DIR": "shards",
+}
+
+def _cassette_url(url):
+    parts = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in HTTP_CASSETTE_IGNORE_PARAMS]
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+def _cassette_body(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    try:
+        fields = parse_qsl(body.decode('utf-8'), keep_blank_values=True, strict_parsing=True)
+    except (ValueError, UnicodeDecodeError):
+        return body
+    # فرم لاگین: مقدار پسورد حذف می‌شود تا نه در فایل بماند نه در کلید اثر بگذارد
+    return urlencode([(k, "***" if CASSETTE_SECRET_FIELDS.search(k) else v) for k, v in fields]).encode('utf-8')
+
+def _redact_set_cookie(value):
+    # نام کوکی (مثل Aut) حفظ می‌شود تا منطق لاگین در بازپخش کار کند؛ مقدارش نه
+    name, _, rest = value.partition('=')
+    attrs = rest.partition(';')[2]
+    return f"{name}=REDACTED" + (f";{attrs}" if attrs else "")
+
+def _cookie_values(request, response):
+    # مقدار کوکی‌های ارسالی و دریافتی (مثل Aut) تا هیچ‌جای کاست نماند
+    values = {v for _, _, v in (c.strip().partition('=') for c in (request.headers.get('Cookie') or "").split(';'))}
+    values.update(response.cookies.values())
+    return sorted((v for v in values if len(v) >= 4), key=len, reverse=True)
+
+def _scrub(text, secrets):
+    for value in secrets:
+        text = text.replace(value, "REDACTED")
+    return text
+
+class _ReplayOriginalResponse:
+    # حداقل چیزی که requests برای استخراج کوکی از پاسخ لازم دارد
+    def __init__(self, header_pairs):
+        self.msg = Parser().parsestr("".join(f"{k}: {v}\n" for k, v in header_pairs) + "\n", headersonly=True)
+
+    def isclosed(self):
+        return True
+
+    def close(self):
+        pass
+
+class HttpCassette:
+    def __init__(self, mode, path):
+        self.mode = mode
+        self.path = path
+        self.lock = Lock()
+        self.exact = defaultdict(deque)
+        self.loose = defaultdict(deque)
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+        elif mode == "record":
+            open(path, 'w', encoding='utf-8').close()
+
+    def _keys(self, method, url, body):
+        loose = (method, _cassette_url(url))
+        return loose + (hashlib.sha1(_cassette_body(body)).hexdigest(),), loose
+
+    def _load(self):
+        count = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                exact = (rec['method'], rec['url'], rec['body_sha1'])
+                self.exact[exact].append(rec)
+                self.loose[exact[:2]].append(rec)
+                count += 1
+        logger.info(f"📼 کاست {self.path}: {count} پاسخ ضبط‌شده برای بازپخش")
+
+    def record(self, request, response):
+        exact, _ = self._keys(request.method, request.url, request.body)
+        header_pairs = list(response.raw.headers.items()) if response.raw is not None else list(response.headers.items())
+        secrets = _cookie_values(request, response)
+        header_pairs = [(k, _redact_set_cookie(v) if k.lower() == 'set-cookie' else _scrub(v, secrets))
+                        for k, v in header_pairs if k.lower() not in CASSETTE_SKIP_HEADERS]
+        content = response.content
+        try:
+            body, encoding = _scrub(content.decode('utf-8'), secrets), 'utf-8'
+        except UnicodeDecodeError:
+            body, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+        rec = {'method': exact[0], 'url': _scrub(exact[1], secrets), 'body_sha1': exact[2],
+               'status': response.status_code, 'reason': response.reason, 'headers': header_pairs,
+               'body': body, 'encoding': encoding, 'elapsed': round(response.elapsed.total_seconds(), 4)}
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def _next(self, request):
+        exact, loose = self._keys(request.method, request.url, request.body)
+        with self.lock:
+            # درخواست تکراری: پاسخ‌ها به ترتیب ضبط، آخرین پاسخ برای تکرارهای بعدی می‌ماند
+            for queue_ in (self.exact.get(exact), self.loose.get(loose)):
+                if queue_:
+                    return queue_.popleft() if len(queue_) > 1 else queue_[0]
+            self.misses += 1
+        return None
+
+    def replay(self, adapter, request):
+        rec = self._next(request)
+        if rec is None:
+            logger.warning(f"📼 پاسخی در کاست نیست: {request.method} {_cassette_url(request.url)}")
+            raise requests.ConnectionError(f"cassette miss: {request.method} {request.url}", request=request)
+        if HTTP_CASSETTE_LATENCY == "recorded" and rec.get('elapsed'):
+            time.sleep(rec['elapsed'] * HTTP_CASSETTE_LATENCY_SCALE)
+        content = base64.b64decode(rec['body']) if rec.get('encoding') == 'base64' else rec['body'].encode('utf-8')
+        # هدرهای تکراری مثل HTTP با کاما ادغام می‌شوند؛ کوکی‌ها از original_response خوانده می‌شوند
+        headers = CaseInsensitiveDict()
+        for k, v in rec['headers']:
+            headers[k] = f"{headers[k]}, {v}" if k in headers else v
+        raw = HTTPResponse(body=io.BytesIO(content), headers=headers, status=rec['status'],
+                           reason=rec.get('reason'), preload_content=False, decode_content=False,
+                           original_response=_ReplayOriginalResponse(rec['headers']))
+        return adapter.build_response(request, raw)
+
+def isolate_replay_state():
+    # فایل‌های وضعیت فعلی کپی می‌شوند تا بازپخش از همان نقطه شروع کند، ولی نوشتن‌ها در پوشه جدا می‌ماند
+    global CACHE_FILE, REPLAY_STATE_DIR
+    state_dir = HTTP_CASSETTE_STATE_DIR or tempfile.mkdtemp(prefix="eways-replay-")
+    os.makedirs(state_dir, exist_ok=True)
+    paths = {name: os.environ.get(name, default) for name, default in CASSETTE_STATE_ENV.items()}
+    paths["CACHE_FILE"] = CACHE_FILE
+    for name, path in paths.items():
+        if not path:
+            continue  # قابلیت خاموش (مثل CHANGE_FEED_FILE خالی) خاموش می‌ماند
+        target = replay_state_path(path, state_dir)
+        if os.path.isdir(path):
+            shutil.copytree(path, target, dirs_exist_ok=True)
+        elif name != "RUN_LOCK_FILE":
+            # نسخه‌های هر فروشگاه (wc_outbox.store2.json) و فایل‌های همراه (.done پلن و ...) هم کپی می‌شوند
+            root, ext = os.path.splitext(path)
+            for src in {path, *glob.glob(f"{glob.escape(path)}.*"), *glob.glob(f"{glob.escape(root)}.*{ext}")}:
+                if os.path.isfile(src):
+                    shutil.copy2(src, replay_state_path(src, state_dir))
+        if name == "CACHE_FILE":
+            CACHE_FILE = target
+        else:
+            os.environ[name] = target
+    REPLAY_STATE_DIR = state_dir
+    logger.info(f"📼 فایل‌های وضعیت بازپخش در {state_dir}")
+    return state_dir
+
+def replay_state_path(path, state_dir=None):
+    state_dir = state_dir or REPLAY_STATE_DIR
+    if not state_dir or not path:
+        return path
+    return os.path.join(state_dir, os.path.basename(os.path.normpath(path)))
+
+def install_http_cassette():
+    if HTTP_CASSETTE_MODE not in ("record", "replay"):
+        return None
+    cassette = HttpCassette(HTTP_CASSETTE_MODE, HTTP_CASSETTE_FILE)
+    if cassette.mode == "replay":
+        isolate_replay_state()
+    original_send = HTTPAdapter.send
+
+    def send(self, request, **kwargs):
+        if cassette.mode == "replay":
+            return cassette.replay(self, request)
+        response = original_send(self, request, **kwargs)
+        cassette.record(request, response)
+        return response
+
+    # همه ترافیک eways و ووکامرس از HTTPAdapter می‌گذرد (سشن eways و requests.get/post)
+    HTTPAdapter.send = send
+    logger.info(f"📼 کاست HTTP در حالت {HTTP_CASSETTE_MODE}: {HTTP_CASSETTE_FILE}")
+    return cassette
+
+HTTP_CASSETTE = install_http_cassette()
+
 # ==============================================================================
 # تنظیمات ریت‌لیمیت جزئیات و سیاست نوسازی
 # ==============================================================================
@@ -57,6 +368,8 @@ DETAILS_MIN_INTERVAL = float(os.environ.get("DETAILS_MIN_INTERVAL", "0.3"))
 REFRESH_SPECS_DAYS = int(os.environ.get("REFRESH_SPECS_DAYS", "7"))
 ALWAYS_DETAILS_FOR_NEW = os.environ.get("ALWAYS_DETAILS_FOR_NEW", "true").lower() == "true"
 CREATE_WITHOUT_DETAILS = os.environ.get("CREATE_WITHOUT_DETAILS", "false").lower() == "true"
+DETAILS_BUDGET = int(os.environ.get("DETAILS_BUDGET", "0"))  # 0 = بدون سقف
+SPECS_REFRESH_JITTER = float(os.environ.get("SPECS_REFRESH_JITTER", "0.3"))
 
 class SimpleRateLimiter:
     def __init__(self, min_interval):
@@ -74,6 +387,223 @@ class SimpleRateLimiter:
 DETAILS_GATE = Semaphore(DETAILS_CONCURRENCY)
 DETAILS_RL = SimpleRateLimiter(DETAILS_MIN_INTERVAL)
 
+# ==============================================================================
+# بودجه زمانی اجرا و قفل انحصاری (اجراهای زمان‌بندی‌شده روی هم نیفتند)
+# ==============================================================================
+RUN_DEADLINE_SEC = float(os.environ.get("RUN_DEADLINE_SEC", "0"))  # 0 = بدون سقف
+RUN_SCRAPE_RESERVE_SEC = float(os.environ.get("RUN_SCRAPE_RESERVE_SEC", "300"))  # بعد از این، دسته جدیدی خزیده نمی‌شود
+RUN_SEND_RESERVE_SEC = float(os.environ.get("RUN_SEND_RESERVE_SEC", "120"))  # بعد از این، جزئیات به اجرای بعد موکول می‌شود
+RUN_LOCK_FILE = os.environ.get("RUN_LOCK_FILE", "run.lock")
+RUN_LOCK_STALE_SEC = float(os.environ.get("RUN_LOCK_STALE_SEC", "3600"))
+_RUN_DEADLINE = [None]
+_RUN_LOCK_TOKEN = [None]
+
+def start_run_deadline():
+    _RUN_DEADLINE[0] = time.monotonic() + RUN_DEADLINE_SEC if RUN_DEADLINE_SEC > 0 else None
+
+def run_time_left():
+    if _RUN_DEADLINE[0] is None:
+        return float('inf')
+    return _RUN_DEADLINE[0] - time.monotonic()
+
+def past_deadline(reserve):
+    return run_time_left() < reserve
+
+def _run_lock_is_stale(info):
+    if time.time() - info.get('started', 0) > RUN_LOCK_STALE_SEC:
+        return True
+    # روی همین ماشین، پروسسی که دیگر زنده نیست قفل را نگه نمی‌دارد
+    if info.get('host') == socket.gethostname() and info.get('pid'):
+        try:
+            os.kill(info['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            return False
+    return False
+
+def _read_lock_holder(path):
+    # None یعنی فایلی نیست؛ فایل نیمه‌نوشته با زمان تغییرش سنجیده می‌شود
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        try:
+            return {"started": os.path.getmtime(path)}
+        except OSError:
+            return None
+
+def _break_stale_lock(holder, token):
+    # قفل کهنه اول به نام یکتا منتقل می‌شود (اتمیک) و فقط اگر همان قفل کهنه بود پاک می‌شود؛
+    # دو پروسس که هم‌زمان قفل کهنه را دیده‌اند نمی‌توانند هر دو آن را بردارند
+    moved = f"{RUN_LOCK_FILE}.stale.{hashlib.sha1(token.encode('utf-8')).hexdigest()[:12]}"
+    try:
+        os.rename(RUN_LOCK_FILE, moved)
+    except FileNotFoundError:
+        return
+    taken = _read_lock_holder(moved) or {}
+    same = taken.get('token') == holder['token'] if holder.get('token') else _run_lock_is_stale(taken)
+    if not same:
+        # در این فاصله پروسس دیگری قفل تازه گرفته بود؛ قفلش برگردانده می‌شود (بدون بازنویسی)
+        try:
+            os.link(moved, RUN_LOCK_FILE)
+        except OSError:
+            logger.warning(f"⚠️ بازگرداندن قفل اجرای {taken.get('pid')} ممکن نشد.")
+        os.remove(moved)
+        return
+    os.remove(moved)
+    logger.warning(f"🔓 قفل کهنه اجرا (pid={holder.get('pid')}) برداشته شد.")
+
+def acquire_run_lock(mode):
+    token = f"{socket.gethostname()}:{os.getpid()}:{time.time()}"
+    info = {"token": token, "host": socket.gethostname(), "pid": os.getpid(), "mode": mode, "started": time.time()}
+    for _ in range(3):
+        try:
+            fd = os.open(RUN_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            holder = _read_lock_holder(RUN_LOCK_FILE)
+            if holder is None:
+                continue
+            if not _run_lock_is_stale(holder):
+                logger.warning(f"⛔️ اجرای دیگری ({holder.get('mode')}، pid={holder.get('pid')}) از "
+                               f"{int(time.time() - holder.get('started', 0))} ثانیه قبل در حال اجراست؛ این اجرا رد شد.")
+                return False
+            _break_stale_lock(holder, token)
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        _RUN_LOCK_TOKEN[0] = token
+        return True
+    return False
+
+def release_run_lock():
+    token, _RUN_LOCK_TOKEN[0] = _RUN_LOCK_TOKEN[0], None
+    if token is None:
+        return
+    try:
+        with open(RUN_LOCK_FILE, 'r', encoding='utf-8') as f:
+            if json.load(f).get('token') != token:
+                return
+        os.remove(RUN_LOCK_FILE)
+    except (OSError, ValueError):
+        pass
+
+# ==============================================================================
+# درخواست‌های پوششی (hedged) برای دم تأخیر پنل
+# ==============================================================================
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.05"))  # حداکثر سهم درخواست‌های اضافه
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_WORKERS = int(os.environ.get("HEDGE_WORKERS", "16"))
+
+class LatencyTracker:
+    def __init__(self, name, window=500):
+        self.name = name
+        self.samples = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q):
+        with self._lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def count_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def try_acquire_hedge(self):
+        # بودجه سخت: تعداد hedgeها هیچ‌وقت از HEDGE_BUDGET کل درخواست‌ها (به‌علاوه یک) بیشتر نمی‌شود
+        with self._lock:
+            if self.hedged + 1 > HEDGE_BUDGET * self.requests + 1:
+                return False
+            self.hedged += 1
+            return True
+
+    def summary(self):
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        fmt = lambda v: "-" if v is None else f"{v:.2f}s"
+        return (f"{self.name}: p50={fmt(p50)} p99={fmt(p99)} | hedge={self.hedged}/{self.requests}"
+                f" | برد hedge={self.hedge_wins}")
+
+DETAILS_LATENCY = LatencyTracker("details")
+LIST_LATENCY = LatencyTracker("list")
+_HEDGE_POOL = None
+_HEDGE_POOL_LOCK = Lock()
+
+def _hedge_pool():
+    global _HEDGE_POOL
+    with _HEDGE_POOL_LOCK:
+        if _HEDGE_POOL is None:
+            _HEDGE_POOL = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _HEDGE_POOL
+
+def _timed(fn, args, kwargs):
+    started = time.monotonic()
+    result = fn(*args, **kwargs)
+    return result, time.monotonic() - started
+
+def _discard_response(tracker):
+    # پاسخ بازنده بسته می‌شود تا اتصال به استخر برگردد؛ زمانش هم ثبت می‌شود تا صدک‌ها فقط از برنده‌ها نباشند
+    def discard(future):
+        if not future.cancelled() and future.exception() is None:
+            response, elapsed = future.result()
+            tracker.observe(elapsed)
+            response.close()
+    return discard
+
+def hedged_call(tracker, fn, *args, limiter=None, **kwargs):
+    # اگر درخواست از صدک HEDGE_PERCENTILE تأخیر آموخته‌شده طول بکشد، نسخه دوم فرستاده می‌شود و اولین پاسخ برنده است
+    tracker.count_request()
+    threshold = tracker.percentile(HEDGE_PERCENTILE) if HEDGE_REQUESTS else None
+    if threshold is None:
+        result, elapsed = _timed(fn, args, kwargs)
+        tracker.observe(elapsed)
+        return result
+    pool = _hedge_pool()
+    primary = pool.submit(_timed, fn, args, kwargs)
+    done, _ = wait_futures([primary], timeout=max(HEDGE_MIN_DELAY, threshold))
+    if done or not tracker.try_acquire_hedge():
+        result, elapsed = primary.result()
+        tracker.observe(elapsed)
+        return result
+    # نسخه دوم هم از همان ریت‌لیمیت درخواست اصلی می‌گذرد
+    if limiter is not None:
+        limiter.wait()
+    hedge = pool.submit(_timed, fn, args, kwargs)
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                first_error = first_error or future.exception()
+                continue
+            result, elapsed = future.result()
+            tracker.observe(elapsed)
+            if future is hedge:
+                tracker.count_win()
+            for other in pending:
+                other.add_done_callback(_discard_response(tracker))
+            return result
+    raise first_error
+
 # ==============================================================================
 # تنظیمات SKU و پیشوندهای قابل قبول
 # ==============================================================================
@@ -107,6 +637,15 @@ def pick_deepest(*cat_ids):
         return None
     return max(candidates, key=lambda c: CATEGORY_DEPTH.get(c, 0))
 
+def in_category_subtrees(cat_id, roots):
+    seen = set()
+    while cat_id and cat_id not in seen:
+        if cat_id in roots:
+            return True
+        seen.add(cat_id)
+        cat_id = CATEGORY_PARENT.get(cat_id)
+    return False
+
 def abs_url(u):
     if not u:
         return u
@@ -193,26 +732,122 @@ def get_selected_categories_according_to_selection(parsed_selection, all_cats):
     return scrape_categories, transfer_categories
 
 # ==============================================================================
-# لاگین
+# لاگین و کلاینت eways (سشن ماندگار + لاگین مجدد خودکار)
 # ==============================================================================
+CAT_WORKERS = int(os.environ.get("CAT_WORKERS", "3"))
+EWAYS_SESSION_FILE = os.environ.get("EWAYS_SESSION_FILE", "eways_session.json")
+EWAYS_SESSION_MAX_AGE_H = float(os.environ.get("EWAYS_SESSION_MAX_AGE_H", "12"))
+EWAYS_POOL_SIZE = int(os.environ.get("EWAYS_POOL_SIZE", "0")) or (CAT_WORKERS + DETAILS_CONCURRENCY + 2)
+
+class EwaysClient:
+    def __init__(self, username, password, pool_size=EWAYS_POOL_SIZE):
+        self.username = username
+        self.password = password
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Referer': f"{BASE_URL}/",
+            'X-Requested-With': 'XMLHttpRequest',
+            'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8'
+        })
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._login_lock = Lock()
+        self._generation = 0
+
+    @property
+    def cookies(self):
+        return self.session.cookies
+
+    @property
+    def headers(self):
+        return self.session.headers
+
+    def load_persisted(self):
+        if not os.path.exists(EWAYS_SESSION_FILE):
+            return False
+        try:
+            with open(EWAYS_SESSION_FILE, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ سشن ذخیره‌شده خوانده نشد: {e}")
+            return False
+        if saved.get('username') != self.username:
+            return False
+        if time.time() - float(saved.get('ts') or 0) > EWAYS_SESSION_MAX_AGE_H * 3600:
+            logger.info("⚠️ سشن ذخیره‌شده قدیمی است؛ لاگین تازه.")
+            return False
+        cookies = saved.get('cookies') or {}
+        if 'Aut' not in cookies:
+            return False
+        self.session.cookies.update(cookies)
+        logger.info("✅ سشن ذخیره‌شده eways بارگذاری شد (بدون لاگین).")
+        return True
+
+    def persist(self):
+        # نام موقت یکتا برای هر پروسس؛ شاردهای هم‌زمان سشن را با هم ذخیره می‌کنند
+        tmp_path = f"{EWAYS_SESSION_FILE}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'username': self.username, 'ts': int(time.time()),
+                           'cookies': requests.utils.dict_from_cookiejar(self.session.cookies)}, f)
+            os.replace(tmp_path, EWAYS_SESSION_FILE)
+        except OSError as e:
+            logger.warning(f"⚠️ ذخیره سشن eways ناموفق: {e}")
+
+    def login(self):
+        logger.info("⏳ در حال لاگین به پنل eways ...")
+        self.session.cookies.clear()
+        resp = self.session.post(f"{BASE_URL}/User/Login", data={"UserName": self.username, "Password": self.password, "RememberMe": "true"}, timeout=30)
+        if resp.status_code != 200:
+            logger.error(f"❌ لاگین ناموفق! کد وضعیت: {resp.status_code} - متن پاسخ: {resp.text[:200]}")
+            return False
+        if 'Aut' in self.session.cookies:
+            logger.info("✅ لاگین موفق! کوکی Aut دریافت شد.")
+            self._generation += 1
+            self.persist()
+            return True
+        logger.error("❌ کوکی Aut دریافت نشد.")
+        return False
+
+    def ensure_login(self):
+        # اعتبارسنجی ارزان: سشن ذخیره‌شده بدون درخواست اضافه پذیرفته می‌شود؛ اولین درخواست واقعی آن را می‌آزماید
+        return self.load_persisted() or self.login()
+
+    @staticmethod
+    def is_auth_failure(resp):
+        if resp.status_code in (401, 403):
+            return True
+        urls = [r.url for r in resp.history] + [resp.url or '']
+        return any('/User/Login' in u for u in urls)
+
+    def relogin(self, seen_generation):
+        with self._login_lock:
+            if self._generation != seen_generation:
+                return True  # رشته دیگری همین حالا لاگین کرده است
+            logger.warning("🔑 سشن eways منقضی شده؛ لاگین مجدد...")
+            return self.login()
+
+    def request(self, method, url, **kwargs):
+        generation = self._generation
+        resp = self.session.request(method, url, **kwargs)
+        if self.is_auth_failure(resp) and '/User/Login' not in url:
+            if self.relogin(generation):
+                resp = self.session.request(method, url, **kwargs)
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
 def login_eways(username, password):
-    session = requests.Session()
-    session.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Referer': f"{BASE_URL}/",
-        'X-Requested-With': 'XMLHttpRequest',
-        'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8'
-    })
-    session.verify = False
-    logger.info("⏳ در حال لاگین به پنل eways ...")
-    resp = session.post(f"{BASE_URL}/User/Login", data={"UserName": username, "Password": password, "RememberMe": "true"}, timeout=30)
-    if resp.status_code != 200:
-        logger.error(f"❌ لاگین ناموفق! کد وضعیت: {resp.status_code} - متن پاسخ: {resp.text[:200]}")
-        return None
-    if 'Aut' in session.cookies:
-        logger.info("✅ لاگین موفق! کوکی Aut دریافت شد.")
-        return session
-    logger.error("❌ کوکی Aut دریافت نشد.")
+    client = EwaysClient(username, password)
+    if client.ensure_login():
+        return client
     return None
 
 # ==============================================================================
@@ -303,7 +938,7 @@ def get_product_details(session, cat_id, product_id):
     try:
         with DETAILS_GATE:
             DETAILS_RL.wait()
-            response = session.get(url, timeout=60)
+            response = hedged_call(DETAILS_LATENCY, session.get, url, limiter=DETAILS_RL, timeout=60)
         response.raise_for_status()
         soup = BeautifulSoup(response.text, 'lxml')
 
@@ -354,135 +989,202 @@ def get_product_details(session, cat_id, product_id):
 # ==============================================================================
 # استخراج محصولات دسته (HTML + Lazy) - مرحله سبک
 # ==============================================================================
+LIST_PAGE_ATTEMPTS = int(os.environ.get("LIST_PAGE_ATTEMPTS", "4"))
+
+def _raise_for_retryable_status(resp):
+    # 5xx و 429 گذرا هستند و همان صفحه دوباره تلاش می‌شود؛ بقیه کدها به فراخواننده برمی‌گردند
+    if resp.status_code >= 500 or resp.status_code == 429:
+        resp.raise_for_status()
+
+@retry(
+    retry=retry_if_exception_type(requests.exceptions.RequestException),
+    stop=stop_after_attempt(LIST_PAGE_ATTEMPTS),
+    wait=wait_random_exponential(multiplier=1, max=10),
+    reraise=True
+)
+def fetch_list_page_html(session, url):
+    resp = hedged_call(LIST_LATENCY, session.get, url, timeout=30)
+    _raise_for_retryable_status(resp)
+    return resp
+
 @retry(
-    retry=retry_if_exception_type((requests.exceptions.RequestException, requests.exceptions.HTTPError)),
-    stop=stop_after_attempt(4),
+    retry=retry_if_exception_type(requests.exceptions.RequestException),
+    stop=stop_after_attempt(LIST_PAGE_ATTEMPTS),
     wait=wait_random_exponential(multiplier=1, max=10),
     reraise=True
 )
-def get_products_from_category_page(session, category_id, max_pages=10, delay=0.5):
+def fetch_list_lazy_chunk(session, data, headers):
+    resp = hedged_call(LIST_LATENCY, session.post, f"{BASE_URL}/Store/ListLazy", data=data, headers=headers, timeout=30)
+    _raise_for_retryable_status(resp)
+    return resp
+
+def parse_list_page_html(html, category_id, seen_product_ids):
+    soup = BeautifulSoup(html, 'lxml')
+    product_blocks = soup.select(".goods-record")
+    html_products = []
+    for block in product_blocks:
+        a_tag = block.select_one("a")
+        name_tag = block.select_one("span.goods-record-title")
+        unavailable = block.select_one(".goods-record-unavailable")
+        is_available = unavailable is None
+        if a_tag and name_tag:
+            link_href = a_tag.get('href', '')
+            cat_from_link, pid = extract_ids_from_href(link_href)
+            if not pid:
+                m = re.search(r'/Store/Detail/\d+/(\d+)', link_href or '')
+                pid = m.group(1) if m else None
+            if not pid:
+                continue
+            name = name_tag.text.strip()
+            price_tag = block.select_one("span.goods-record-price")
+            price_text = price_tag.text.strip() if price_tag else ""
+            price = re.sub(r'[^\d]', '', price_text) if price_text else "0"
+            image_tag = block.select_one("img.goods-record-image")
+            image_url = ""
+            if image_tag:
+                image_url = image_tag.get('data-src', '') or image_tag.get('src', '')
+                image_url = abs_url(image_url)
+            if is_available and pid not in seen_product_ids:
+                eff_cat_guess = pick_deepest(category_id, cat_from_link)
+                html_products.append({
+                    'id': pid, 'name': name,
+                    'category_id': eff_cat_guess,
+                    'detail_hint_cat_id': cat_from_link or category_id,
+                    'price': price, 'stock': 1,
+                    'image': image_url, 'specs': {},
+                })
+                seen_product_ids.add(pid)
+    return html_products
+
+def parse_lazy_goods(goods, category_id, seen_product_ids):
+    lazy_products = []
+    for g in goods:
+        if not g.get("Availability", True):
+            continue
+        pid = str(g["Id"])
+        if pid in seen_product_ids:
+            continue
+        cat_from_link = None
+        for k in ("Url", "Link", "Href", "RelativeUrl"):
+            u = g.get(k)
+            if u and "/Store/Detail/" in u:
+                c, p2 = extract_ids_from_href(u)
+                if c: cat_from_link = c
+                break
+        eff_cat_guess = pick_deepest(category_id, cat_from_link)
+        lazy_products.append({
+            "id": pid, "name": g["Name"], "category_id": eff_cat_guess,
+            "detail_hint_cat_id": cat_from_link or category_id,
+            "price": g.get("Price", "0"), "stock": 1,
+            "image": abs_url(g.get("ImageUrl", "")), "specs": {},
+        })
+        seen_product_ids.add(pid)
+    return lazy_products
+
+def listing_fingerprint(products):
+    h = hashlib.sha1()
+    for p in sorted(products, key=lambda p: str(p['id'])):
+        h.update(f"{p['id']}:{p.get('price')}:{p.get('stock')};".encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def get_products_from_category_page(session, category_id, max_pages=10, delay=0.5, crawl_info=None,
+                                    known_fingerprint=None):
+    # تلاش مجدد در سطح هر صفحه/هر Lazy است؛ خطای نهایی یک صفحه فقط همان دسته را از همان‌جا متوقف می‌کند
+    # و صفحات موفق قبلی حفظ می‌شوند. crawl_info (اختیاری) وضعیت کامل بودن خزش را برمی‌گرداند.
+    # اگر اثر انگشت HTML صفحه اول با known_fingerprint یکی باشد، خزش همان‌جا تمام می‌شود (crawl_info['unchanged'])
     all_products_in_category = []
     seen_product_ids = set()
     page = 1
-    error_count = 0
+    complete = True
     while page <= max_pages:
         if page == 1:
             url = f"{BASE_URL}/Store/List/{category_id}/2/2/0/0/0/10000000000"
         else:
             url = f"{BASE_URL}/Store/List/{category_id}/2/2/{page-1}/0/0/10000000000?brands=&isMobile=false"
-        logger.info(f"⏳ دریافت HTML صفحه {page} برای دسته {cat_label(category_id)} ...")
+        logger.debug(f"⏳ دریافت HTML صفحه {page} برای دسته {cat_label(category_id)} ...")
+        try:
+            resp = fetch_list_page_html(session, url)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"❌ صفحه {page} دسته {cat_label(category_id)} پس از {LIST_PAGE_ATTEMPTS} تلاش ناموفق: {e}")
+            complete = False
+            break
+        if page == 1 and resp.status_code in (404, 410):
+            # دسته حذف‌شده: لیست خالی و کامل، تا محصولات قبلی‌اش ناموجود شوند
+            logger.warning(f"⚠️ دسته {cat_label(category_id)} در پنل وجود ندارد (status: {resp.status_code})")
+            break
+        if resp.status_code != 200:
+            logger.error(f"❌ خطا در دریافت HTML صفحه {page} - status: {resp.status_code} - url: {url}")
+            complete = False
+            break
         try:
-            resp = session.get(url, timeout=30)
+            html_products = parse_list_page_html(resp.text, category_id, seen_product_ids)
+        except Exception as e:
+            logger.error(f"    - خطا در پردازش صفحه {page} دسته {cat_label(category_id)}: {e}")
+            complete = False
+            break
+        logger.debug(f"🟢 محصولات موجود (HTML) صفحه {page}: {len(html_products)}")
+        if page == 1 and crawl_info is not None:
+            crawl_info['fingerprint'] = listing_fingerprint(html_products)
+            if known_fingerprint and crawl_info['fingerprint'] == known_fingerprint:
+                crawl_info.update(complete=True, pages=1, unchanged=True)
+                return html_products
+
+        # Lazy
+        lazy_products = []
+        lazy_page = 1
+        referer_url = url
+        while True:
+            data = {
+                "ListViewType": 0, "CatId": category_id, "Order": 2, "Sort": 2,
+                "LazyPageIndex": lazy_page, "PageIndex": page - 1, "PageSize": 24,
+                "Available": 1, "MinPrice": 0, "MaxPrice": 10000000000, "IsLazyLoading": "true"
+            }
+            headers = {
+                "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+                "X-Requested-With": "XMLHttpRequest",
+                "Referer": referer_url
+            }
+            logger.debug(f"⏳ LazyPageIndex={lazy_page} صفحه {page} برای دسته {cat_label(category_id)} ...")
+            try:
+                resp = fetch_list_lazy_chunk(session, data, headers)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"❌ Lazy {lazy_page} صفحه {page} پس از {LIST_PAGE_ATTEMPTS} تلاش ناموفق: {e}")
+                complete = False
+                break
             if resp.status_code != 200:
-                logger.error(f"❌ خطا در دریافت HTML صفحه {page} - status: {resp.status_code} - url: {url}")
+                logger.error(f"❌ خطا در Lazy (کد: {resp.status_code})")
+                complete = False
                 break
-            soup = BeautifulSoup(resp.text, 'lxml')
-            product_blocks = soup.select(".goods-record")
-            html_products = []
-            for block in product_blocks:
-                a_tag = block.select_one("a")
-                name_tag = block.select_one("span.goods-record-title")
-                unavailable = block.select_one(".goods-record-unavailable")
-                is_available = unavailable is None
-                if a_tag and name_tag:
-                    link_href = a_tag.get('href', '')
-                    cat_from_link, pid = extract_ids_from_href(link_href)
-                    if not pid:
-                        m = re.search(r'/Store/Detail/\d+/(\d+)', link_href or '')
-                        pid = m.group(1) if m else None
-                    if not pid:
-                        continue
-                    name = name_tag.text.strip()
-                    price_tag = block.select_one("span.goods-record-price")
-                    price_text = price_tag.text.strip() if price_tag else ""
-                    price = re.sub(r'[^\d]', '', price_text) if price_text else "0"
-                    image_tag = block.select_one("img.goods-record-image")
-                    image_url = ""
-                    if image_tag:
-                        image_url = image_tag.get('data-src', '') or image_tag.get('src', '')
-                        image_url = abs_url(image_url)
-                    if is_available and pid not in seen_product_ids:
-                        eff_cat_guess = pick_deepest(category_id, cat_from_link)
-                        html_products.append({
-                            'id': pid, 'name': name,
-                            'category_id': eff_cat_guess,
-                            'detail_hint_cat_id': cat_from_link or category_id,
-                            'price': price, 'stock': 1,
-                            'image': image_url, 'specs': {},
-                        })
-                        seen_product_ids.add(pid)
-            logger.info(f"🟢 محصولات موجود (HTML) صفحه {page}: {len(html_products)}")
-
-            # Lazy
-            lazy_products = []
-            lazy_page = 1
-            referer_url = url
-            while True:
-                data = {
-                    "ListViewType": 0, "CatId": category_id, "Order": 2, "Sort": 2,
-                    "LazyPageIndex": lazy_page, "PageIndex": page - 1, "PageSize": 24,
-                    "Available": 1, "MinPrice": 0, "MaxPrice": 10000000000, "IsLazyLoading": "true"
-                }
-                headers = {
-                    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-                    "X-Requested-With": "XMLHttpRequest",
-                    "Referer": referer_url
-                }
-                logger.info(f"⏳ LazyPageIndex={lazy_page} صفحه {page} برای دسته {cat_label(category_id)} ...")
-                resp = session.post(f"{BASE_URL}/Store/ListLazy", data=data, headers=headers, timeout=30)
-                if resp.status_code != 200:
-                    logger.error(f"❌ خطا در Lazy (کد: {resp.status_code})")
-                    break
-                try:
-                    result = resp.json()
-                except Exception as e:
-                    logger.error(f"❌ JSON Lazy نامعتبر: {e}")
-                    logger.error(f"متن:\n{resp.text[:500]}")
-                    break
-                if not result or "Goods" not in result or not result["Goods"]:
-                    logger.info(f"🚩 انتهای Lazy صفحه {page}.")
-                    break
-                goods = result["Goods"]
-                for g in goods:
-                    if not g.get("Availability", True):
-                        continue
-                    pid = str(g["Id"])
-                    if pid in seen_product_ids:
-                        continue
-                    cat_from_link = None
-                    for k in ("Url", "Link", "Href", "RelativeUrl"):
-                        u = g.get(k)
-                        if u and "/Store/Detail/" in u:
-                            c, p2 = extract_ids_from_href(u)
-                            if c: cat_from_link = c
-                            break
-                    eff_cat_guess = pick_deepest(category_id, cat_from_link)
-                    lazy_products.append({
-                        "id": pid, "name": g["Name"], "category_id": eff_cat_guess,
-                        "detail_hint_cat_id": cat_from_link or category_id,
-                        "price": g.get("Price", "0"), "stock": 1,
-                        "image": abs_url(g.get("ImageUrl", "")), "specs": {},
-                    })
-                    seen_product_ids.add(pid)
-                logger.info(f"🟢 محصولات موجود (Lazy) این حلقه: {len([g for g in goods if g.get('Availability', True)])}")
-                lazy_page += 1
-
-            available_in_page = html_products + lazy_products
-            if not available_in_page:
-                logger.info(f"⛔️ هیچ محصول موجودی در صفحه {page} نبود. توقف این دسته.")
+            try:
+                result = resp.json()
+            except Exception as e:
+                logger.error(f"❌ JSON Lazy نامعتبر: {e}")
+                logger.error(f"متن:\n{resp.text[:500]}")
+                complete = False
                 break
-            all_products_in_category.extend(available_in_page)
-            page += 1
-            error_count = 0
-            time.sleep(random.uniform(delay, delay + 0.2))
-        except Exception as e:
-            error_count += 1
-            logger.error(f"    - خطا در پردازش صفحه محصولات: {e} (تعداد خطا: {error_count})")
-            if error_count >= 3:
-                logger.critical(f"🚨 خطاهای متوالی زیاد در دسته {cat_label(category_id)}. توقف.")
+            if not result or "Goods" not in result or not result["Goods"]:
+                logger.debug(f"🚩 انتهای Lazy صفحه {page}.")
                 break
-            time.sleep(2)
-    logger.info(f"    - کل محصولات موجود استخراج‌شده از دسته {cat_label(category_id)}: {len(all_products_in_category)}")
+            goods = result["Goods"]
+            lazy_products.extend(parse_lazy_goods(goods, category_id, seen_product_ids))
+            logger.debug(f"🟢 محصولات موجود (Lazy) این حلقه: {sum(1 for g in goods if g.get('Availability', True))}")
+            lazy_page += 1
+
+        available_in_page = html_products + lazy_products
+        if not complete:
+            # Lazy ناموفق: محصولات دیده‌شده همین صفحه نگه داشته می‌شوند و خزش دسته همین‌جا متوقف می‌شود
+            all_products_in_category.extend(available_in_page)
+            break
+        if not available_in_page:
+            logger.debug(f"⛔️ هیچ محصول موجودی در صفحه {page} نبود. توقف این دسته.")
+            break
+        all_products_in_category.extend(available_in_page)
+        page += 1
+        time.sleep(random.uniform(delay, delay + 0.2))
+    logger.debug(f"    - کل محصولات موجود استخراج‌شده از دسته {cat_label(category_id)}: {len(all_products_in_category)}")
+    if crawl_info is not None:
+        crawl_info['complete'] = complete
+        crawl_info['pages'] = page - 1 if complete else page
     return all_products_in_category
 
 # ==============================================================================
@@ -498,19 +1200,146 @@ def load_cache():
     return {}
 
 def save_cache(products):
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
+    # نوشتن اتمیک تا سرویس جست‌وجو (serve) هیچ‌وقت فایل نیمه‌کاره نخواند
+    tmp_path = CACHE_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(products, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, CACHE_FILE)
     logger.info(f"✅ کش ذخیره شد. تعداد: {len(products)}")
 
+# ==============================================================================
+# فروشگاه‌های مقصد ووکامرس (یک اسکرپ، چند فروشگاه)
+# ==============================================================================
+WC_TARGETS_FILE = os.environ.get("WC_TARGETS_FILE", "wc_targets.json")
+WC_TARGET_WORKERS = int(os.environ.get("WC_TARGET_WORKERS", "4"))
+
+class WcTarget:
+    # مقدار None یعنی استفاده از تنظیم سراسری (WC_API_URL، WC_BATCH_SIZE، PRICE_RULES و ...)
+    def __init__(self, name="default", api_url=None, consumer_key=None, consumer_secret=None,
+                 batch_size=None, batch_workers=None, price_rules=None, plan_file=None):
+        self.name = name
+        self.api_url = api_url
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.batch_size = batch_size
+        self.batch_workers = batch_workers
+        self.price_rules = price_rules
+        self.plan_file = plan_file
+
+    @property
+    def url(self):
+        return self.api_url or WC_API_URL
+
+    @property
+    def auth(self):
+        return (self.consumer_key or WC_CONSUMER_KEY, self.consumer_secret or WC_CONSUMER_SECRET)
+
+    @property
+    def workers(self):
+        return max(1, self.batch_workers or WC_BATCH_WORKERS)
+
+    @property
+    def chunk_size(self):
+        return min(100, self.batch_size or WC_BATCH_SIZE)
+
+    def _scoped_path(self, path):
+        if self.name == "default":
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self.name}{ext}"
+
+    @property
+    def plan_path(self):
+        return self.plan_file or self._scoped_path(PLAN_FILE)
+
+    @property
+    def outbox_path(self):
+        return self._scoped_path(WC_OUTBOX_FILE)
+
+    def price(self, price_value):
+        return process_price(price_value, self.price_rules)
+
+DEFAULT_WC_TARGET = WcTarget()
+
+def _store_tag(target):
+    return "" if target.name == "default" else f"[{target.name}] "
+
+def load_wc_targets():
+    if not WC_TARGETS_FILE or not os.path.exists(WC_TARGETS_FILE):
+        return [DEFAULT_WC_TARGET]
+    try:
+        with open(WC_TARGETS_FILE, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"❌ فایل فروشگاه‌ها {WC_TARGETS_FILE} خوانده نشد؛ فقط فروشگاه پیش‌فرض: {e}")
+        return [DEFAULT_WC_TARGET]
+    targets = []
+    for i, item in enumerate(raw):
+        # کلیدها می‌توانند مستقیم یا از متغیر محیطی (برای secrets) بیایند
+        def value(key):
+            env_name = item.get(f"{key}_env")
+            return os.environ.get(env_name) if env_name else item.get(key)
+        name = item.get("name") or ("default" if i == 0 else f"store{i}")
+        price_rules = item.get("price_rules")
+        try:
+            if item.get("price_rules_file"):
+                with open(item["price_rules_file"], 'r', encoding='utf-8') as f:
+                    price_rules = json.load(f)
+            if price_rules:
+                price_rules = validate_price_rules(price_rules)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error(f"❌ جدول قیمت فروشگاه {name} نامعتبر است، از جدول سراسری استفاده می‌شود: {e}")
+            price_rules = None
+        targets.append(WcTarget(
+            name=name,
+            api_url=value("url"), consumer_key=value("consumer_key"), consumer_secret=value("consumer_secret"),
+            batch_size=item.get("batch_size"), batch_workers=item.get("batch_workers"),
+            price_rules=price_rules, plan_file=replay_state_path(item.get("plan_file")),
+        ))
+    if not targets:
+        return [DEFAULT_WC_TARGET]
+    logger.info(f"🏬 فروشگاه‌های مقصد: {[t.name for t in targets]}")
+    return targets
+
+def run_per_target(targets, fn):
+    # هر فروشگاه در رشته خودش؛ خطای یک فروشگاه بقیه را متوقف نمی‌کند
+    results = {}
+    errors = {}
+    lock = Lock()
+    sem = Semaphore(max(1, WC_TARGET_WORKERS))
+
+    def worker(target):
+        with sem:
+            try:
+                result = fn(target)
+            except Exception as e:
+                logger.error(f"❌ فروشگاه {target.name}: {e}")
+                with lock:
+                    errors[target.name] = e
+                return
+            with lock:
+                results[target.name] = result
+
+    if len(targets) == 1:
+        worker(targets[0])
+    else:
+        threads = [Thread(target=worker, args=(t,)) for t in targets]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return results, errors
+
 # ==============================================================================
 # ووکامرس
 # ==============================================================================
-def get_wc_categories():
+def get_wc_categories(target=None):
+    target = target or DEFAULT_WC_TARGET
     wc_cats, page = [], 1
     while True:
         try:
-            res = requests.get(f"{WC_API_URL}/products/categories",
-                               auth=(WC_CONSUMER_KEY, WC_CONSUMER_SECRET),
+            res = requests.get(f"{target.url}/products/categories",
+                               auth=target.auth,
                                params={"per_page": 100, "page": page},
                                verify=False, timeout=30)
             res.raise_for_status()
@@ -526,16 +1355,21 @@ def get_wc_categories():
     logger.info(f"✅ دسته‌های ووکامرس: {len(wc_cats)}")
     return wc_cats
 
-def get_all_wc_products_with_prefixes(prefixes=None):
+def get_all_wc_products_with_prefixes(prefixes=None, modified_after=None, target=None):
+    target = target or DEFAULT_WC_TARGET
     prefixes = prefixes or SKU_PREFIXES
     products = []
     page = 1
+    params = {"per_page": 100, "status": "any"}
+    if modified_after:
+        # دریافت افزایشی: فقط محصولاتی که بعد از این زمان (UTC) تغییر کرده‌اند
+        params.update({"modified_after": modified_after, "dates_are_gmt": "true"})
     while True:
         try:
             res = requests.get(
-                f"{WC_API_URL}/products",
-                auth=(WC_CONSUMER_KEY, WC_CONSUMER_SECRET),
-                params={"per_page": 100, "page": page, "status": "any"},
+                f"{target.url}/products",
+                auth=target.auth,
+                params=dict(params, page=page),
                 verify=False, timeout=30
             )
             res.raise_for_status()
@@ -556,35 +1390,108 @@ def get_all_wc_products_with_prefixes(prefixes=None):
     logger.info(f"✅ محصولات ووکامرس با پیشوندهای {prefixes}: {len(products)}")
     return products
 
-def find_wc_product_id_by_sku(sku):
+# ==============================================================================
+# یافتن گروهی محصول با SKU جایگزین (همه پیشوندها، چند SKU در هر درخواست)
+# ==============================================================================
+# هر درخواست حداکثر 100 نتیجه برمی‌گرداند (per_page=100)؛ دسته بزرگ‌تر نتیجه‌ها را جا می‌اندازد
+ALT_SKU_BATCH = max(1, min(100, int(os.environ.get("ALT_SKU_BATCH", "50"))))
+ALT_SKU_WORKERS = int(os.environ.get("ALT_SKU_WORKERS", "4"))
+ALT_SKU_NEGATIVE_FILE = os.environ.get("ALT_SKU_NEGATIVE_FILE", "alt_sku_negative.json")
+ALT_SKU_NEGATIVE_TTL_H = float(os.environ.get("ALT_SKU_NEGATIVE_TTL_H", "24"))
+
+def load_alt_sku_negative():
+    if not ALT_SKU_NEGATIVE_FILE or not os.path.exists(ALT_SKU_NEGATIVE_FILE):
+        return {}
     try:
-        res = requests.get(
-            f"{WC_API_URL}/products",
-            auth=(WC_CONSUMER_KEY, WC_CONSUMER_SECRET),
-            params={"sku": sku, "status": "any", "per_page": 100},
-            verify=False, timeout=20
-        )
-        res.raise_for_status()
-        items = res.json()
-        if items:
-            return items[0].get("id")
-        return None
-    except Exception as e:
-        logger.debug(f"⚠️ جستجوی SKU در ووکامرس خطا داد ({sku}): {e}")
-        return None
+        with open(ALT_SKU_NEGATIVE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"⚠️ کش منفی SKU خوانده نشد: {e}")
+        return {}
 
-def find_wc_product_id_by_possible_skus(pid):
-    for prefix in SKU_PREFIXES:
-        sku_try = f"{prefix}{pid}"
-        pid_found = find_wc_product_id_by_sku(sku_try)
-        if pid_found:
-            return pid_found, sku_try
-    return None, None
+def save_alt_sku_negative(negative):
+    if not ALT_SKU_NEGATIVE_FILE:
+        return
+    tmp_path = ALT_SKU_NEGATIVE_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(negative, f, separators=(',', ':'))
+    os.replace(tmp_path, ALT_SKU_NEGATIVE_FILE)
+
+def find_wc_products_by_skus(skus, target=None):
+    # پارامتر sku ووکامرس چند مقدار جداشده با کاما می‌پذیرد
+    target = target or DEFAULT_WC_TARGET
+    res = requests.get(
+        f"{target.url}/products",
+        auth=target.auth,
+        params={"sku": ",".join(skus), "status": "any", "per_page": 100},
+        verify=False, timeout=30
+    )
+    res.raise_for_status()
+    wanted = set(skus)
+    return {p.get('sku'): p.get('id') for p in res.json() if p.get('sku') in wanted}
+
+def resolve_alt_skus(pids, target=None):
+    # خروجی: pid → (wc_id, sku)؛ pidهایی که هیچ پیشوندی نداشتند تا TTL در کش منفی می‌مانند
+    target = target or DEFAULT_WC_TARGET
+    now = time.time()
+    negative_all = load_alt_sku_negative()
+    negative = {pid: ts for pid, ts in (negative_all.get(target.name) or {}).items()
+                if now - ts < ALT_SKU_NEGATIVE_TTL_H * 3600}
+    pending = sorted({str(pid) for pid in pids} - negative.keys())
+    if not pending:
+        return {}
+    skus = [f"{prefix}{pid}" for pid in pending for prefix in SKU_PREFIXES]
+    chunks = [skus[i:i + ALT_SKU_BATCH] for i in range(0, len(skus), ALT_SKU_BATCH)]
+    found, failed = {}, set()
+    lock = Lock()
+    chunk_queue = Queue()
+    for chunk in chunks:
+        chunk_queue.put(chunk)
+
+    def worker():
+        while True:
+            try:
+                chunk = chunk_queue.get_nowait()
+            except Exception:
+                break
+            try:
+                result = find_wc_products_by_skus(chunk, target)
+            except Exception as e:
+                logger.debug(f"⚠️ جستجوی گروهی SKU خطا داد ({len(chunk)} SKU): {e}")
+                with lock:
+                    failed.update(chunk)
+                continue
+            with lock:
+                found.update(result)
 
-def check_existing_category(name, parent):
+    threads = [Thread(target=worker) for _ in range(max(1, min(ALT_SKU_WORKERS, len(chunks))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    resolved = {}
+    for pid in pending:
+        # مثل قبل، پیشوند زودتر در SKU_PREFIXES اولویت دارد
+        for prefix in SKU_PREFIXES:
+            sku = f"{prefix}{pid}"
+            if sku in found:
+                resolved[pid] = (found[sku], sku)
+                break
+        else:
+            if not any(f"{prefix}{pid}" in failed for prefix in SKU_PREFIXES):
+                negative[pid] = now
+    negative_all[target.name] = negative
+    save_alt_sku_negative(negative_all)
+    logger.info(f"🔎 {_store_tag(target)}SKU جایگزین: {len(resolved)} یافت شد از {len(pending)} "
+                f"({len(chunks)} درخواست، در کش منفی: {len(pids) - len(pending)})")
+    return resolved
+
+def check_existing_category(name, parent, target=None):
+    target = target or DEFAULT_WC_TARGET
     try:
-        res = requests.get(f"{WC_API_URL}/products/categories",
-                           auth=(WC_CONSUMER_KEY, WC_CONSUMER_SECRET),
+        res = requests.get(f"{target.url}/products/categories",
+                           auth=target.auth,
                            params={"search": name, "per_page": 1, "parent": parent},
                            verify=False, timeout=20)
         res.raise_for_status()
@@ -597,8 +1504,13 @@ def check_existing_category(name, parent):
         logger.debug(f"⚠️ چک وجود دسته '{name}' (parent: {parent}) خطا: {e}")
         return None
 
-def transfer_categories_to_wc(source_categories):
-    logger.info("\n⏳ شروع انتقال دسته‌بندی‌ها به ووکامرس...")
+def transfer_categories_to_wc(source_categories, known_map=None, target=None, wc_categories=None):
+    # wc_categories: فهرست کامل دسته‌های ووکامرس (از get_wc_categories)؛ با آن برای هر دسته درخواست جست‌وجو فرستاده نمی‌شود
+    target = target or DEFAULT_WC_TARGET
+    existing_by_key = None
+    if wc_categories:
+        existing_by_key = {(c["name"].strip(), c["parent"]): c["id"] for c in wc_categories}
+    logger.info(f"\n⏳ شروع انتقال دسته‌بندی‌ها به ووکامرس ({target.name})...")
     sorted_cats = []
     id_to_cat = {cat['id']: cat for cat in source_categories}
     def add_with_parents_if_present(cat):
@@ -612,21 +1524,27 @@ def transfer_categories_to_wc(source_categories):
     for cat in source_categories:
         add_with_parents_if_present(cat)
 
-    source_to_wc_id_map = {}
+    source_to_wc_id_map = dict(known_map or {})
     transferred = 0
-    for cat in tqdm(sorted_cats, desc="انتقال دسته‌ها"):
+    for cat in tqdm(sorted_cats, desc=f"انتقال دسته‌ها ({target.name})"):
+        if cat["id"] in source_to_wc_id_map:
+            transferred += 1
+            continue
         name = cat["name"].strip()
         parent_id = cat.get("parent_id") or 0
         wc_parent = source_to_wc_id_map.get(parent_id, 0)
-        existing_id = check_existing_category(name, wc_parent)
+        if existing_by_key is not None:
+            existing_id = existing_by_key.get((name, wc_parent))
+        else:
+            existing_id = check_existing_category(name, wc_parent, target)
         if existing_id:
             source_to_wc_id_map[cat["id"]] = existing_id
             transferred += 1
             continue
         data = {"name": name, "parent": wc_parent}
         try:
-            res = requests.post(f"{WC_API_URL}/products/categories",
-                                auth=(WC_CONSUMER_KEY, WC_CONSUMER_SECRET),
+            res = requests.post(f"{target.url}/products/categories",
+                                auth=target.auth,
                                 json=data, verify=False, timeout=30)
             if res.status_code in [200, 201]:
                 new_id = res.json()["id"]
@@ -645,118 +1563,441 @@ def transfer_categories_to_wc(source_categories):
     logger.info(f"✅ انتقال دسته‌بندی‌ها کامل شد: {transferred}/{len(source_categories)}")
     return source_to_wc_id_map
 
-def process_price(price_value):
+# ==============================================================================
+# جدول قیمت‌گذاری (قابل تنظیم با PRICE_RULES یا PRICE_RULES_FILE)
+# ==============================================================================
+# هر ردیف: سقف قیمت (تومان، None = بی‌سقف) و یکی از price/add/mul؛ اولین ردیفی که قیمت از سقفش کمتر باشد اعمال می‌شود
+DEFAULT_PRICE_RULES = [
+    {"max": 1, "price": 0},
+    {"max": 7000000, "add": 260000},
+    {"max": 10000000, "mul": 1.035},
+    {"max": 20000000, "mul": 1.025},
+    {"max": 30000000, "mul": 1.02},
+    {"max": None, "mul": 1.015},
+]
+PRICE_DIVISOR = float(os.environ.get("PRICE_DIVISOR", "10"))
+PRICE_ROUND_DIGITS = int(os.environ.get("PRICE_ROUND_DIGITS", "-4"))
+PRICE_RULES_FILE = os.environ.get("PRICE_RULES_FILE", "price_rules.json")
+
+def validate_price_rules(rules):
+    for rule in rules:
+        if not any(k in rule for k in ("price", "add", "mul")):
+            raise ValueError(f"ردیف بدون price/add/mul: {rule}")
+    # ردیف بی‌سقف همیشه آخر
+    return sorted(rules, key=lambda r: float('inf') if r.get('max') is None else float(r['max']))
+
+def load_price_rules():
+    raw, source = os.environ.get("PRICE_RULES"), "PRICE_RULES"
+    if not raw and PRICE_RULES_FILE and os.path.exists(PRICE_RULES_FILE):
+        with open(PRICE_RULES_FILE, 'r', encoding='utf-8') as f:
+            raw, source = f.read(), PRICE_RULES_FILE
+    if not raw:
+        return DEFAULT_PRICE_RULES
+    try:
+        rules = validate_price_rules(json.loads(raw))
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f"❌ جدول قیمت {source} نامعتبر است، از جدول پیش‌فرض استفاده می‌شود: {e}")
+        return DEFAULT_PRICE_RULES
+    logger.info(f"💲 جدول قیمت از {source}: {len(rules)} ردیف")
+    return rules
+
+PRICE_RULES = load_price_rules()
+
+def apply_price_rule(price_value, rules):
+    for rule in rules:
+        if rule.get('max') is not None and price_value > float(rule['max']):
+            continue
+        if 'price' in rule:
+            return float(rule['price'])
+        if 'add' in rule:
+            return price_value + float(rule['add'])
+        return price_value * float(rule['mul'])
+    return price_value
+
+def process_price(price_value, rules=None):
     try:
         price_value = float(re.sub(r'[^\d.]', '', str(price_value)))
-        price_value /= 10
-    except (ValueError, TypeError):
+        price_value /= PRICE_DIVISOR
+    except (ValueError, TypeError, ZeroDivisionError):
+        return "0"
+    new_price = apply_price_rule(price_value, rules or PRICE_RULES)
+    if new_price <= 0:
         return "0"
-    if price_value <= 1: return "0"
-    elif price_value <= 7000000: new_price = price_value + 260000
-    elif price_value <= 10000000: new_price = price_value * 1.035
-    elif price_value <= 20000000: new_price = price_value * 1.025
-    elif price_value <= 30000000: new_price = price_value * 1.02
-    else: new_price = price_value * 1.015
-    return str(int(round(new_price, -4)))
+    return str(int(round(new_price, PRICE_ROUND_DIGITS)))
+
+# ==============================================================================
+# ایندکس یکپارچه pid ↔ محصول ووکامرس (یک‌بار در هر اجرا)
+# ==============================================================================
+class WcProductIndex:
+    def __init__(self, wc_products, prefixes=None):
+        prefixes = prefixes or SKU_PREFIXES
+        rank = {pref: i for i, pref in enumerate(prefixes)}
+        self.by_pid = {}
+        self.entries = []
+        for p in wc_products:
+            sku = p.get('sku') or ''
+            prefix = next((pref for pref in prefixes if sku.startswith(pref)), None)
+            if prefix is None:
+                continue
+            pid = sku[len(prefix):]
+            entry = {
+                'id': p.get('id'),
+                'sku': sku,
+                'pid': pid,
+                'prefix': prefix,
+                'categories': frozenset(c.get('id') for c in (p.get('categories') or []) if isinstance(c, dict)),
+                'stock_status': p.get('stock_status'),
+                'has_image': bool(p.get('images')),
+                'regular_price': p.get('regular_price'),
+            }
+            self.entries.append(entry)
+            # مثل قبل، پیشوند زودتر در SKU_PREFIXES اولویت دارد
+            current = self.by_pid.get(pid)
+            if current is None or rank[prefix] < rank[current['prefix']]:
+                self.by_pid[pid] = entry
+
+    def __len__(self):
+        return len(self.by_pid)
+
+    def get(self, pid):
+        return self.by_pid.get(str(pid))
+
+    def missing(self, pids):
+        return set(pids) - self.by_pid.keys()
+
+    def category_mismatches(self, products_by_pid, category_mapping):
+        result = set()
+        for pid, p in products_by_pid.items():
+            entry = self.by_pid.get(pid)
+            if not entry:
+                continue
+            expected = category_mapping.get(p.get('category_id'))
+            if expected and expected not in entry['categories']:
+                result.add(pid)
+        return result
+
+    def outofstock_candidates(self, present_pids):
+        # هر محصول ووکامرس (با هر پیشوند) که pidش در اسکرپ فعلی نیست و هنوز موجود است
+        return {e['id'] for e in self.entries
+                if e['pid'] not in present_pids and e['stock_status'] != "outofstock"}
 
 # ==============================================================================
-# ارسال/آپدیت ووکامرس
+# ارسال/آپدیت ووکامرس (گروهی)
 # ==============================================================================
+WC_BATCH_SIZE = min(100, int(os.environ.get("WC_BATCH_SIZE", "100")))
+WC_BATCH_WORKERS = int(os.environ.get("WC_BATCH_WORKERS", "2"))
+DUPLICATE_SKU_CODES = ("product_invalid_sku", "woocommerce_product_sku_already_exists")
+
 @retry(
-    retry=retry_if_exception_type((requests.exceptions.RequestException, requests.exceptions.HTTPError)),
+    retry=retry_if_exception_type(requests.exceptions.RequestException),
     stop=stop_after_attempt(3),
     wait=wait_random_exponential(multiplier=1, max=10),
     reraise=True
 )
-def _send_to_woocommerce(sku, data, stats, existing_product_id=None):
+def _post_wc_batch(payload, target=None):
+    target = target or DEFAULT_WC_TARGET
+    res = requests.post(f"{target.url}/products/batch",
+                        auth=target.auth,
+                        json=payload, verify=False, timeout=60)
+    res.raise_for_status()
+    return res.json()
+
+def update_payload_from_wc_data(data):
+    update_data = {
+        "regular_price": data["regular_price"],
+        "stock_quantity": data["stock_quantity"],
+        "stock_status": data["stock_status"],
+        "categories": data.get("categories", []),
+    }
+    if data.get("attributes") is not None:
+        update_data["attributes"] = data["attributes"]
+    if data.get("tags") is not None:
+        update_data["tags"] = data["tags"]
+    # فقط اگر عمداً images گذاشته باشیم، ارسال کن
+    if data.get("images"):
+        update_data["images"] = data["images"]
+    if MIGRATE_REMOTE_SKU_TO_CANONICAL:
+        update_data["sku"] = data["sku"]
+    return update_data
+
+def _batch_item(action):
+    if action['op'] == 'create':
+        return action['payload']
+    return dict(action['payload'], id=action['wc_id'])
+
+def _apply_batch(actions, stats, on_done, target=None):
+    creates = [a for a in actions if a['op'] == 'create']
+    updates = [a for a in actions if a['op'] != 'create']
+    payload = {}
+    if creates:
+        payload["create"] = [_batch_item(a) for a in creates]
+    if updates:
+        payload["update"] = [_batch_item(a) for a in updates]
     try:
-        auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-        if existing_product_id:
-            update_data = {
-                "regular_price": data["regular_price"],
-                "stock_quantity": data["stock_quantity"],
-                "stock_status": data["stock_status"],
-                "categories": data.get("categories", []),
-            }
-            if data.get("attributes") is not None:
-                update_data["attributes"] = data["attributes"]
-            if data.get("tags") is not None:
-                update_data["tags"] = data["tags"]
-            # فقط اگر عمداً images گذاشته باشیم، ارسال کن
-            if data.get("images"):
-                update_data["images"] = data["images"]
-            if MIGRATE_REMOTE_SKU_TO_CANONICAL:
-                update_data["sku"] = data["sku"]
-
-            res = requests.put(f"{WC_API_URL}/products/{existing_product_id}",
-                               auth=auth, json=update_data, verify=False, timeout=20)
-            res.raise_for_status()
-            with stats['lock']: stats['updated'] += 1
-        else:
-            if (data.get("attributes") is None) and (not CREATE_WITHOUT_DETAILS):
-                logger.warning(f"   ⚠️ ساخت {sku} رد شد؛ جزئیات نداریم و CREATE_WITHOUT_DETAILS=false است.")
-                with stats['lock']: stats['failed'] += 1
-                return
-            try:
-                res = requests.post(f"{WC_API_URL}/products",
-                                    auth=auth, json=data, verify=False, timeout=20)
-                res.raise_for_status()
-                with stats['lock']: stats['created'] += 1
-            except requests.exceptions.HTTPError as e:
-                try:
-                    payload = e.response.json()
-                except Exception:
-                    payload = {}
-                code = (payload or {}).get("code")
-                resource_id = (payload or {}).get("data", {}).get("resource_id")
-                if code in ("product_invalid_sku", "woocommerce_product_sku_already_exists") and resource_id:
-                    logger.info(f"   🔄 SKU تکراری برای {sku}؛ آپدیت روی resource_id={resource_id}")
-                    update_data = {
-                        "regular_price": data["regular_price"],
-                        "stock_quantity": data["stock_quantity"],
-                        "stock_status": data["stock_status"],
-                        "categories": data.get("categories", []),
-                    }
-                    if data.get("attributes") is not None:
-                        update_data["attributes"] = data["attributes"]
-                    if data.get("tags") is not None:
-                        update_data["tags"] = data["tags"]
-                    if data.get("images"):
-                        update_data["images"] = data["images"]
-                    if MIGRATE_REMOTE_SKU_TO_CANONICAL:
-                        update_data["sku"] = data["sku"]
-                    res2 = requests.put(f"{WC_API_URL}/products/{resource_id}",
-                                        auth=auth, json=update_data, verify=False, timeout=20)
-                    res2.raise_for_status()
-                    with stats['lock']: stats['updated'] += 1
-                else:
-                    logger.error(f"   ❌ HTTP خطا برای {sku}: {e.response.status_code} - {e.response.text[:300]}")
-                    raise
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"   ❌ HTTP خطا برای {sku}: {e.response.status_code} - {e.response.text[:300]}")
-        raise
+        result = _post_wc_batch(payload, target)
     except Exception as e:
-        logger.error(f"   ❌ خطای ووکامرس برای {sku}: {e}")
-        raise
+        logger.error(f"   ❌ خطای درخواست گروهی ووکامرس ({len(actions)} قلم): {e}")
+        with stats['lock']: stats['failed'] += len(actions)
+        return []
+
+    done, retry_as_update = [], []
+    for action, item in zip(creates, result.get("create") or []):
+        err = item.get("error")
+        if not err:
+            done.append(action)
+            with stats['lock']:
+                stats['created'] += 1
+                stats['wc_ids'][action['sku']] = item.get('id')
+            continue
+        resource_id = (err.get("data") or {}).get("resource_id")
+        if err.get("code") in DUPLICATE_SKU_CODES and resource_id:
+            logger.debug(f"   🔄 SKU تکراری برای {action['sku']}؛ آپدیت روی resource_id={resource_id}")
+            retry_as_update.append(dict(action, op='update', wc_id=resource_id,
+                                        payload=update_payload_from_wc_data(action['payload']), _origin=action))
+        else:
+            logger.error(f"   ❌ ساخت {action['sku']} ناموفق: {err.get('code')} - {err.get('message')}")
+            with stats['lock']: stats['failed'] += 1
+    for action, item in zip(updates, result.get("update") or []):
+        err = item.get("error")
+        if err:
+            logger.error(f"   ❌ آپدیت {action.get('sku') or action['wc_id']} ناموفق: {err.get('code')} - {err.get('message')}")
+            with stats['lock']: stats['failed'] += 1
+            continue
+        done.append(action)
+        with stats['lock']:
+            stats['outofstock_updated' if action['op'] == 'outofstock' else 'updated'] += 1
+    logger.debug(f"   ✅ بسته گروهی: موفق={len(done)} از {len(actions)}")
+
+    if retry_as_update:
+        for action in _apply_batch(retry_as_update, stats, None, target):
+            done.append(action['_origin'])
+    if on_done and done:
+        on_done(done)
+    return done
 
-@retry(
-    retry=retry_if_exception_type((requests.exceptions.RequestException, requests.exceptions.HTTPError)),
-    stop=stop_after_attempt(3),
-    wait=wait_random_exponential(multiplier=1, max=10),
-    reraise=True
-)
-def update_to_outofstock(product_id, stats):
+# ==============================================================================
+# صف ماندگار نوشتن‌های ناموفق ووکامرس (outbox)
+# ==============================================================================
+# کش قبل از ارسال ذخیره می‌شود؛ بدون این صف، محصولی که ارسالش شکست خورده در اجرای بعد «بدون تغییر» دیده می‌شود
+WC_OUTBOX_FILE = os.environ.get("WC_OUTBOX_FILE", "wc_outbox.json")
+WC_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("WC_OUTBOX_MAX_ATTEMPTS", "20"))
+
+def _outbox_keys(action):
+    keys = set()
+    if action.get('pid'):
+        keys.add(f"pid:{action['pid']}")
+    if action.get('wc_id'):
+        keys.add(f"wc:{action['wc_id']}")
+    return keys
+
+def load_outbox(path):
+    if not os.path.exists(path):
+        return []
     try:
-        auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-        update_data = {"stock_quantity": 0, "stock_status": "outofstock", "manage_stock": True}
-        res = requests.put(f"{WC_API_URL}/products/{product_id}",
-                           auth=auth, json=update_data, verify=False, timeout=20)
-        res.raise_for_status()
-        logger.info(f"   ✅ محصول {product_id} ناموجود شد.")
-        with stats['lock']: stats['outofstock_updated'] += 1
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
     except Exception as e:
-        logger.error(f"   ❌ خطا در ناموجود کردن {product_id}: {e}")
-        with stats['lock']: stats['failed'] += 1
+        logger.warning(f"⚠️ صف ارسال {path} خوانده نشد: {e}")
+        return []
+
+def save_outbox(path, entries):
+    if not entries and not os.path.exists(path):
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def outbox_pending(entries, actions):
+    # اقدام تازه برای همان محصول (pid یا wc_id)، نسخه قدیمی صف را باطل می‌کند؛
+    # ولی شمار تلاش‌های آن به اقدام تازه می‌رسد تا سقف WC_OUTBOX_MAX_ATTEMPTS دور زده نشود
+    fresh = {}
+    for a in actions:
+        for key in _outbox_keys(a):
+            fresh[key] = a['id']
+    pending, replaced = [], {}
+    for e in entries:
+        ids = {fresh[key] for key in _outbox_keys(e['action']) if key in fresh}
+        if not ids:
+            pending.append(e)
+            continue
+        for action_id in ids:
+            prev = replaced.get(action_id)
+            if prev is None or e.get('attempts', 0) > prev.get('attempts', 0):
+                replaced[action_id] = e
+    return pending, replaced
+
+def outbox_entries(failed_actions, previous_by_id):
+    now = int(time.time())
+    entries = []
+    for action in failed_actions:
+        prev = previous_by_id.get(action['id']) or {}
+        attempts = prev.get('attempts', 0) + 1
+        if attempts > WC_OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"❌ {action['id']} پس از {attempts - 1} تلاش از صف ارسال حذف شد.")
+            continue
+        entries.append({"action": action, "attempts": attempts, "queued_ts": prev.get('queued_ts', now)})
+    return entries
+
+# ==============================================================================
+# پلن همگام‌سازی: محاسبه یک‌باره تغییرات، اعمال گروهی و قابل ادامه
+# ==============================================================================
+PLAN_FILE = os.environ.get("PLAN_FILE", "sync_plan.json")
+
+def outofstock_action(wc_id):
+    return {"id": f"outofstock:{wc_id}", "op": "outofstock", "wc_id": wc_id,
+            "payload": {"stock_quantity": 0, "stock_status": "outofstock", "manage_stock": True}}
+
+def new_plan(actions, skipped=None):
+    return {
+        "version": 1,
+        "created_ts": int(time.time()),
+        "actions": actions,
+        "skipped": skipped or {},
+    }
+
+def save_plan(plan, path=PLAN_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    # پلن تازه، پیشرفت پلن قبلی را باطل می‌کند
+    if os.path.exists(path + ".done"):
+        os.remove(path + ".done")
+    logger.info(f"📝 پلن ذخیره شد: {path} ({len(plan['actions'])} اقدام)")
+
+def load_plan(path=PLAN_FILE):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _load_done_ids(path):
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    done.add(line)
+    return done
+
+def apply_sync_plan(plan, plan_path=None, target=None):
+    target = target or DEFAULT_WC_TARGET
+    # اگر plan_path داده شود، اقدام‌های موفق در plan_path.done ثبت می‌شوند و اجرای دوباره فقط باقی‌مانده‌ها را می‌فرستد
+    skipped = plan.get('skipped') or {}
+    stats = {'created': 0, 'updated': 0, 'outofstock_updated': 0,
+             'failed': skipped.get('no_details', 0), 'no_category': skipped.get('no_category', 0),
+             'wc_ids': {}, 'done_ids': set(), 'outbox_drained': 0, 'lock': Lock()}
+    progress_path = plan_path + ".done" if plan_path else None
+    already_done = _load_done_ids(progress_path)
+    pending = [a for a in plan['actions'] if a['id'] not in already_done]
+    if already_done:
+        logger.info(f"↪️ ادامه پلن: {len(already_done)} اقدام قبلاً انجام شده، {len(pending)} باقی‌مانده")
+
+    # اقدام‌های ناموفق اجراهای قبل، پیش از پلن فرستاده می‌شوند (done_ids فقط شامل اقدام‌های همین پلن است)
+    outbox = load_outbox(target.outbox_path)
+    drain, replaced_by_id = outbox_pending(outbox, plan['actions'])
+    if outbox:
+        logger.info(f"📮 {_store_tag(target)}صف ارسال: {len(drain)} اقدام معوق ارسال می‌شود"
+                    f" ({len(outbox) - len(drain)} با پلن جدید جایگزین شد)")
+    drained_by_id = {e['action']['id']: e for e in drain}
+    pending = [e['action'] for e in drain] + pending
+    if not pending:
+        if outbox:
+            save_outbox(target.outbox_path, [])
+        return stats
+
+    progress_lock = Lock()
+    progress_file = open(progress_path, 'a', encoding='utf-8') if progress_path else None
+    drained_done = set()
+
+    def on_done(actions):
+        with progress_lock:
+            plan_done = [a for a in actions if a['id'] not in drained_by_id]
+            drained_done.update(a['id'] for a in actions if a['id'] in drained_by_id)
+            for a in plan_done:
+                stats['done_ids'].add(a['id'])
+            if progress_file and plan_done:
+                progress_file.write("".join(f"{a['id']}\n" for a in plan_done))
+                progress_file.flush()
+
+    batch_queue = Queue()
+    for i in range(0, len(pending), target.chunk_size):
+        batch_queue.put(pending[i:i + target.chunk_size])
+    pbar = tqdm(total=len(pending), desc=f"ارسال گروهی به ووکامرس ({target.name})")
+    pbar_lock = Lock()
+
+    def batch_worker():
+        while True:
+            try:
+                batch = batch_queue.get_nowait()
+            except Exception:
+                break
+            _apply_batch(batch, stats, on_done, target)
+            with pbar_lock:
+                pbar.update(len(batch))
+            if SENDER_SLEEP_SEC > 0:
+                time.sleep(random.uniform(0, SENDER_SLEEP_SEC))
+            batch_queue.task_done()
+
+    threads = []
+    for _ in range(target.workers):
+        t = Thread(target=batch_worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    pbar.close()
+    if progress_file:
+        progress_file.close()
+    stats['outbox_drained'] = len(drained_done)
+    failed = [a for a in pending if a['id'] not in stats['done_ids'] and a['id'] not in drained_done]
+    save_outbox(target.outbox_path, outbox_entries(failed, {**replaced_by_id, **drained_by_id}))
+    if failed:
+        logger.warning(f"📮 {_store_tag(target)}{len(failed)} اقدام ناموفق برای اجرای بعد در صف ارسال ماند")
+    return stats
+
+def log_apply_summary(stats, send_count, target=None):
+    logger.info("\n===============================")
+    if target is not None and target.name != "default":
+        logger.info(f"🏬 فروشگاه: {target.name}")
+    logger.info(f"📦 موجود (ارسال‌شده): {send_count}")
+    logger.info(f"🟢 ایجاد شده: {stats['created']}")
+    logger.info(f"🔵 آپدیت شده: {stats['updated']}")
+    logger.info(f"🟠 به ناموجود: {stats['outofstock_updated']}")
+    logger.info(f"🔴 شکست: {stats['failed']}")
+    if stats.get('outbox_drained'):
+        logger.info(f"📮 از صف ارسال اجرای قبل: {stats['outbox_drained']}")
+    logger.info(f"🟡 بدون دسته: {stats.get('no_category', 0)}")
+    logger.info("===============================\nتمام!")
+
+def apply_plan_file(target):
+    path = target.plan_path
+    if not os.path.exists(path):
+        logger.error(f"❌ فایل پلن پیدا نشد: {path}")
+        return None
+    plan = load_plan(path)
+    logger.info(f"📝 اعمال پلن {path}: {len(plan['actions'])} اقدام (ساخته‌شده در {_utc_iso(plan.get('created_ts', 0))} UTC)")
+    stats = apply_sync_plan(plan, plan_path=path, target=target)
+    log_apply_summary(stats, sum(1 for a in plan['actions'] if a['op'] != 'outofstock'), target)
+    return stats
+
+def run_apply():
+    targets = load_wc_targets()
+    results, _ = run_per_target(targets, apply_plan_file)
+    primary = targets[0]
+    if primary.name not in results or not results[primary.name]:
+        return
+    # وضعیت کش/فید/تاریخچه پلن اصلی فقط یک بار و برای اقدام‌های انجام‌شده (همه اجراهای apply) ثبت می‌شود
+    plan = load_plan(primary.plan_path)
+    state = plan.pop('state', None)
+    if not state:
+        return
+    done_ids = _load_done_ids(primary.plan_path + ".done")
+    commit_sync_state(state, plan, done_ids, results[primary.name].get('wc_ids'))
+    tmp_path = primary.plan_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, primary.plan_path)
 
 # ==============================================================================
 # برچسب‌گذاری
@@ -794,89 +2035,83 @@ def smart_tags_for_product(product, cat_map):
     return [{"name": t} for t in sorted(tags)]
 
 # ==============================================================================
-# ارسال محصول به ووکامرس
+# ساخت اقدام ارسال محصول به ووکامرس
 # ==============================================================================
-def process_product_wrapper(args):
-    product, stats, category_mapping, cat_map, wc_by_sku, wc_missing_image_skus = args
-    try:
-        wc_cat_id = category_mapping.get(product.get('category_id'))
-        if not wc_cat_id:
-            logger.warning(f"   ⚠️ دسته برای محصول {product.get('id')} پیدا نشد. رد شد.")
-            with stats['lock']: stats['no_category'] = stats.get('no_category', 0) + 1
-            return
-
-        specs = product.get('specs') or {}
-        has_details = bool(specs)
-
-        attributes = None
-        if has_details:
-            attributes = []
-            for idx, (key, value) in enumerate(specs.items()):
-                attributes.append({"name": key, "options": [value], "position": idx, "visible": True, "variation": False})
-
-        pid_str = str(product.get('id'))
-        canonical_sku = f"EWAYS-{pid_str}"
-        sku = canonical_sku
-
-        # بررسی وجود محصول در WC (بدون درخواست اضافی)
-        existing_wc_id = None
-        existing_sku_hit = None
-        candidate_skus = [f"{pref}{pid_str}" for pref in SKU_PREFIXES]
-
-        for s in candidate_skus:
-            wcp = wc_by_sku.get(s)
-            if wcp:
-                existing_wc_id = wcp.get('id')
-                existing_sku_hit = s
-                break
-
-        # جست‌وجوی alt SKU اختیاری (برای سرعت پیش‌فرض خاموش)
-        if not existing_wc_id and ALT_SKU_LOOKUP:
-            alt_id, alt_sku = find_wc_product_id_by_possible_skus(pid_str)
-            if alt_id:
-                logger.info(f"🔎 محصول یافت شد با SKU جایگزین: {alt_sku} → ID={alt_id} (آپدیت به‌جای ساخت)")
-                existing_wc_id = alt_id
-                existing_sku_hit = alt_sku
-
-        # تصمیم ارسال تصویر:
-        # - اگر محصول جدید است → تصویر بفرست
-        # - اگر محصول موجود است و طبق لیست WC تصویر ندارد → تصویر بفرست
-        include_images = (existing_wc_id is None) or any(s in wc_missing_image_skus for s in candidate_skus)
-
-        images_data = None
-        if include_images and product.get("image"):
-            images_data = [{"src": abs_url(product.get("image"))}]
-
-        wc_data = {
-            "name": product.get('name', 'بدون نام'),
-            "type": "simple",
-            "sku": sku,
-            "regular_price": process_price(product.get('price', 0)),
-            "categories": [{"id": wc_cat_id}],
-            "stock_quantity": product.get('stock', 0),
-            "manage_stock": True,
-            "stock_status": "instock" if product.get('stock', 0) > 0 else "outofstock",
-            "attributes": attributes,
-            "tags": smart_tags_for_product(product, cat_map) if has_details else None,
-            "status": "publish"
-        }
-        if images_data:
-            wc_data["images"] = images_data
+def build_product_action(product, category_mapping, cat_map, wc_index, skipped, target=None, alt_ids=None):
+    target = target or DEFAULT_WC_TARGET
+    wc_cat_id = category_mapping.get(product.get('category_id'))
+    if not wc_cat_id:
+        logger.debug(f"   ⚠️ دسته برای محصول {product.get('id')} پیدا نشد. رد شد.")
+        skipped['no_category'] = skipped.get('no_category', 0) + 1
+        return None
 
-        _send_to_woocommerce(wc_data['sku'], wc_data, stats, existing_product_id=existing_wc_id)
-        # تنفس بسیار کوتاه (قابل تنظیم)
-        if SENDER_SLEEP_SEC > 0:
-            time.sleep(random.uniform(0, SENDER_SLEEP_SEC))
-    except Exception as e:
-        logger.error(f"   ❌ خطا در پردازش محصول {product.get('id','')}: {e}")
-        with stats['lock']: stats['failed'] += 1
+    specs = product.get('specs') or {}
+    has_details = bool(specs)
+
+    attributes = None
+    if has_details:
+        attributes = []
+        for idx, (key, value) in enumerate(specs.items()):
+            attributes.append({"name": key, "options": [value], "position": idx, "visible": True, "variation": False})
+
+    pid_str = str(product.get('id'))
+    canonical_sku = f"EWAYS-{pid_str}"
+    sku = canonical_sku
+
+    # بررسی وجود محصول در WC (بدون درخواست اضافی)
+    entry = wc_index.get(pid_str)
+    existing_wc_id = entry['id'] if entry else None
+    missing_image = bool(entry) and not entry['has_image']
+
+    # نتیجه جست‌وجوی گروهی SKU جایگزین (resolve_alt_skus) برای محصولاتی که در ایندکس نیستند
+    if not existing_wc_id and alt_ids and pid_str in alt_ids:
+        alt_id, alt_sku = alt_ids[pid_str]
+        logger.info(f"🔎 محصول یافت شد با SKU جایگزین: {alt_sku} → ID={alt_id} (آپدیت به‌جای ساخت)")
+        existing_wc_id = alt_id
+
+    # تصمیم ارسال تصویر:
+    # - اگر محصول جدید است → تصویر بفرست
+    # - اگر محصول موجود است و طبق لیست WC تصویر ندارد → تصویر بفرست
+    include_images = (existing_wc_id is None) or missing_image
+
+    images_data = None
+    if include_images and product.get("image"):
+        images_data = [{"src": abs_url(product.get("image"))}]
+
+    wc_data = {
+        "name": product.get('name', 'بدون نام'),
+        "type": "simple",
+        "sku": sku,
+        "regular_price": target.price(product.get('price', 0)),
+        "categories": [{"id": wc_cat_id}],
+        "stock_quantity": product.get('stock', 0),
+        "manage_stock": True,
+        "stock_status": "instock" if product.get('stock', 0) > 0 else "outofstock",
+        "attributes": attributes,
+        "tags": smart_tags_for_product(product, cat_map) if has_details else None,
+        "status": "publish"
+    }
+    if images_data:
+        wc_data["images"] = images_data
+
+    if existing_wc_id:
+        return {"id": f"update:{sku}", "op": "update", "pid": pid_str, "sku": sku,
+                "wc_id": existing_wc_id, "payload": update_payload_from_wc_data(wc_data)}
+    if (attributes is None) and (not CREATE_WITHOUT_DETAILS):
+        logger.debug(f"   ⚠️ ساخت {sku} رد شد؛ جزئیات نداریم و CREATE_WITHOUT_DETAILS=false است.")
+        skipped['no_details'] = skipped.get('no_details', 0) + 1
+        return None
+    wc_data = {k: v for k, v in wc_data.items() if v is not None}
+    return {"id": f"create:{sku}", "op": "create", "pid": pid_str, "sku": sku, "payload": wc_data}
 
 # ==============================================================================
 # ابزارهای تجمیع محصول به leaf و کش و جزئیات Selective
 # ==============================================================================
 def condense_products_to_leaf(all_products_by_catkey, categories):
     occurrences = defaultdict(list)
-    for key, p in all_products_by_catkey.items():
+    # ترتیب ثابت (مستقل از ترتیب پایان رشته‌های خزش) تا پلن و بدنه درخواست‌های گروهی قابل تکرار باشند
+    for key in sorted(all_products_by_catkey):
+        p = all_products_by_catkey[key]
         occurrences[str(p['id'])].append(p)
     canonical = {}
     for pid, plist in occurrences.items():
@@ -906,15 +2141,19 @@ def normalize_cache(cached_products, categories):
             normalized[str(pid)] = p
         return normalized
 
-def print_products_tree_by_leaf(products_by_pid, categories):
+def dump_products_tree_by_leaf(products_by_pid, categories, path):
     cat_map = {cat['id']: cat['name'] for cat in categories}
     tree = defaultdict(list)
     for pid, p in products_by_pid.items():
         tree[p.get('category_id')].append(p)
+    lines = []
     for catid in sorted(tree, key=lambda x: (0 if x is None else int(x))):
-        logger.info(f"دسته [{catid}] {cat_map.get(int(catid), 'نامشخص') if catid else 'نامشخص'}:")
+        lines.append(f"دسته [{catid}] {cat_map.get(int(catid), 'نامشخص') if catid else 'نامشخص'}:")
         for p in sorted(tree[catid], key=lambda x: int(x['id'])):
-            logger.info(f"   - {p['name']} (ID: {p['id']})")
+            lines.append(f"   - {p['name']} (ID: {p['id']})")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    logger.info(f"🌳 درخت محصولات در {path} نوشته شد.")
 
 def light_changed(old, new):
     return (
@@ -929,15 +2168,114 @@ def full_changed(old, new):
         return True
     return (old or {}).get('specs') != (new or {}).get('specs')
 
-def is_specs_stale(old):
+# ==============================================================================
+# مقایسه یک‌جای کاتالوگ قبلی و فعلی (یک پیمایش، قابل به‌روزرسانی برای چند pid)
+# ==============================================================================
+def _light_differs(old, new):
+    # همان light_changed؛ تبدیل str/int فقط وقتی مقدار خام فرق دارد
+    a, b = old.get('price'), new.get('price')
+    if a != b and str(a) != str(b):
+        return True
+    a, b = old.get('stock', 0), new.get('stock', 0)
+    if a != b and int(a) != int(b):
+        return True
+    return old.get('category_id') != new.get('category_id')
+
+def diff_catalogs(old_products, new_products, pids=None):
+    # new: فقط در فعلی | changed: قیمت/موجودی/دسته | specs_changed: مشخصات | removed: فقط در قبلی
+    diff = {'new': set(), 'changed': set(), 'specs_changed': set(),
+            'removed': old_products.keys() - new_products.keys()}
+    refresh_diff(diff, old_products, new_products, new_products if pids is None else pids)
+    return diff
+
+def refresh_diff(diff, old_products, new_products, pids):
+    # فقط ردیف‌های pids دوباره سنجیده می‌شوند (مثلاً بعد از دریافت جزئیات)
+    added, changed, specs_changed = diff['new'], diff['changed'], diff['specs_changed']
+    get_old = old_products.get
+    for pid in pids:
+        p = new_products[pid]
+        old = get_old(pid)
+        if old is None:
+            added.add(pid)
+            continue
+        if _light_differs(old, p):
+            changed.add(pid)
+        else:
+            changed.discard(pid)
+        if old.get('specs') != p.get('specs'):
+            specs_changed.add(pid)
+        else:
+            specs_changed.discard(pid)
+    return diff
+
+def diff_light(diff):
+    return diff['new'] | diff['changed']
+
+def diff_full(diff):
+    return diff['new'] | diff['changed'] | diff['specs_changed']
+
+def specs_ttl_seconds(pid):
+    # انقضای پخش‌شده: هر محصول ضریب ثابت خودش را در بازه ±SPECS_REFRESH_JITTER دارد
+    h = int(hashlib.md5(str(pid).encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return REFRESH_SPECS_DAYS * 86400 * (1 + SPECS_REFRESH_JITTER * (2 * h - 1))
+
+def is_specs_stale(old, pid=None):
     if not old: return True
     ts = old.get('details_ts')
     if not ts: return True
     try:
-        return (time.time() - float(ts)) > REFRESH_SPECS_DAYS * 86400
+        ttl = specs_ttl_seconds(pid if pid is not None else old.get('id'))
+        return (time.time() - float(ts)) > ttl
     except:
         return True
 
+DETAIL_PRIORITY_BLOCKED_NEW = 0
+DETAIL_PRIORITY_MISMATCH = 1
+DETAIL_PRIORITY_CHANGED = 2
+DETAIL_PRIORITY_STALE = 3
+
+def build_detail_schedule(canonical_products, cached_products, missing_in_wc, mismatch, changed_light):
+    # ترتیب: جدیدهای مسدود (بدون جزئیات ساخته نمی‌شوند) ← دسته نامنطبق ← تغییرکرده/بی‌مشخصات ← مشخصات کهنه
+    priorities = {}
+    for pid, p in canonical_products.items():
+        old = cached_products.get(pid)
+        has_specs = bool(p.get('specs'))
+        if pid in missing_in_wc and not has_specs and not CREATE_WITHOUT_DETAILS:
+            # فقط وقتی ساخت بدون جزئیات ممکن نیست، مسدود حساب می‌شود
+            prio = DETAIL_PRIORITY_BLOCKED_NEW
+        elif pid in mismatch:
+            prio = DETAIL_PRIORITY_MISMATCH
+        elif pid in changed_light or pid in missing_in_wc:
+            prio = DETAIL_PRIORITY_CHANGED
+        elif ALWAYS_DETAILS_FOR_NEW and not old:
+            prio = DETAIL_PRIORITY_CHANGED
+        elif not (old and old.get('specs')):
+            prio = DETAIL_PRIORITY_CHANGED
+        elif is_specs_stale(old, pid):
+            prio = DETAIL_PRIORITY_STALE
+        else:
+            continue
+        priorities[pid] = prio
+
+    def sort_key(pid):
+        old = cached_products.get(pid) or {}
+        try:
+            ts = float(old.get('details_ts') or 0)
+        except (TypeError, ValueError):
+            ts = 0.0
+        return (priorities[pid], ts, pid)
+
+    ordered = sorted(priorities, key=sort_key)
+    tier_counts = Counter(priorities.values())
+    logger.info(f"🔎 صف جزئیات: مسدود جدید={tier_counts[DETAIL_PRIORITY_BLOCKED_NEW]} | "
+                f"دسته نامنطبق={tier_counts[DETAIL_PRIORITY_MISMATCH]} | "
+                f"تغییرکرده/بی‌مشخصات={tier_counts[DETAIL_PRIORITY_CHANGED]} | "
+                f"کهنه={tier_counts[DETAIL_PRIORITY_STALE]}")
+    if DETAILS_BUDGET > 0 and len(ordered) > DETAILS_BUDGET:
+        logger.info(f"⏳ سقف جزئیات این اجرا {DETAILS_BUDGET}؛ {len(ordered) - DETAILS_BUDGET} قلم به اجراهای بعد موکول شد.")
+        ordered = ordered[:DETAILS_BUDGET]
+    return ordered
+
 def merge_specs_from_cache(products_by_pid, cached):
     for pid, p in products_by_pid.items():
         old = cached.get(pid)
@@ -951,10 +2289,13 @@ def enrich_products_with_details(session, products_by_pid, pids_to_enrich):
     for pid in pids_to_enrich:
         if pid in products_by_pid:
             q.put(pid)
-    stats = {'ok': 0, 'fail': 0}
+    stats = {'ok': 0, 'fail': 0, 'deferred': 0}
     lock = Lock()
     def worker():
         while True:
+            # نزدیک پایان بودجه زمانی، باقی صف (کم‌اولویت‌ترها) به اجرای بعد موکول می‌شود
+            if past_deadline(RUN_SEND_RESERVE_SEC):
+                break
             try:
                 pid = q.get_nowait()
             except Exception:
@@ -983,24 +2324,25 @@ def enrich_products_with_details(session, products_by_pid, pids_to_enrich):
         threads.append(t)
     for t in threads:
         t.join()
+    stats['deferred'] = q.qsize()
+    if stats['deferred']:
+        logger.warning(f"⏳ بودجه زمانی اجرا: {stats['deferred']} قلم جزئیات به اجرای بعد موکول شد.")
     logger.info(f"✅ جزئیات تکمیلی: موفق={stats['ok']} | ناموفق={stats['fail']}")
+    logger.info(f"⏱️ {DETAILS_LATENCY.summary()}")
 
 # ==============================================================================
-# تابع اصلی
+# انتخاب دسته‌ها و جمع‌آوری محصولات (Light)
 # ==============================================================================
-def main():
-    session = login_eways(EWAYS_USERNAME, EWAYS_PASSWORD)
-    if not session:
-        logger.error("❌ لاگین انجام نشد. پایان.")
-        return
+DEFAULT_SELECTED_IDS_STRING = "1582:14548-allz,1584-all-allz|1583:17893-allz|16777:all-allz|4882:all-allz|16778:22570-all-allz"
 
+def load_selection(session):
     all_cats = get_and_parse_categories(session)
     if not all_cats:
         logger.error("❌ دسته‌بندی‌ها بارگذاری نشد.")
-        return
+        return None
     init_category_index_global(all_cats)
 
-    SELECTED_IDS_STRING = os.environ.get("SELECTED_IDS_STRING") or  "1582:14548-allz,1584-all-allz|1583:17893-allz|16777:all-allz|4882:all-allz|16778:22570-all-allz"
+    SELECTED_IDS_STRING = os.environ.get("SELECTED_IDS_STRING") or DEFAULT_SELECTED_IDS_STRING
     parsed_selection = parse_selected_ids_string(SELECTED_IDS_STRING)
 
     scrape_categories, transfer_categories = get_selected_categories_according_to_selection(parsed_selection, all_cats)
@@ -1017,30 +2359,214 @@ def main():
     transfer_list = [f"{c['id']} ({c['name']})" for c in transfer_categories]
     logger.info(f"✅ دسته‌های اسکرپ: {scrape_list}")
     logger.info(f"✅ دسته‌های انتقال (با والدها): {transfer_list}")
+    return {
+        'all_cats': all_cats,
+        'parsed_selection': parsed_selection,
+        'scrape_categories': scrape_categories,
+        'transfer_categories': transfer_categories,
+    }
 
-    category_mapping = transfer_categories_to_wc(transfer_categories)
-    if not category_mapping:
-        logger.error("❌ نگاشت دسته‌بندی ووکامرس ساخته نشد.")
-        return
+# ==============================================================================
+# آمار دسته‌ها بین اجراها و زمان‌بندی LPT
+# ==============================================================================
+CATEGORY_STATS_FILE = os.environ.get("CATEGORY_STATS_FILE", "category_stats.json")
+CAT_SCHEDULE = os.environ.get("CAT_SCHEDULE", "lpt").lower()
+CAT_CHANGE_PRIORITY = float(os.environ.get("CAT_CHANGE_PRIORITY", "0"))
+CAT_STATS_ALPHA = 0.5
+
+def load_category_stats():
+    if os.path.exists(CATEGORY_STATS_FILE):
+        try:
+            with open(CATEGORY_STATS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ آمار دسته‌ها خوانده نشد: {e}")
+    return {}
+
+def save_category_stats(cat_stats):
+    tmp_path = CATEGORY_STATS_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cat_stats, f, ensure_ascii=False)
+    os.replace(tmp_path, CATEGORY_STATS_FILE)
+
+def _ewma(old, value):
+    if old is None:
+        return value
+    return CAT_STATS_ALPHA * value + (1 - CAT_STATS_ALPHA) * old
+
+def record_category_crawl(cat_stats, cat_id, duration, count):
+    st = cat_stats.setdefault(str(cat_id), {})
+    st['duration'] = round(_ewma(st.get('duration'), duration), 3)
+    st['count'] = count
+    st['runs'] = st.get('runs', 0) + 1
+    st['last_ts'] = int(time.time())
+
+def record_category_deferred(cat_stats, cat_id):
+    # دسته‌ای که به بودجه زمانی نرسید، در اجرای بعد جلوی صف می‌آید (schedule_categories)
+    st = cat_stats.setdefault(str(cat_id), {})
+    st['deferred'] = st.get('deferred', 0) + 1
+
+def record_category_change_rates(cat_stats, canonical_products, changed_pids):
+    # تغییرات هر محصول به leaf و همه اجدادش نسبت داده می‌شود (لیست والد شامل فرزندان است)
+    totals, changed = Counter(), Counter()
+    for pid, p in canonical_products.items():
+        cid = p.get('category_id')
+        hit = pid in changed_pids
+        seen = set()
+        while cid and cid not in seen:
+            seen.add(cid)
+            totals[cid] += 1
+            if hit:
+                changed[cid] += 1
+            cid = CATEGORY_PARENT.get(cid)
+    for cid, total in totals.items():
+        st = cat_stats.get(str(cid))
+        if st is None:
+            continue
+        st['change_rate'] = round(_ewma(st.get('change_rate'), changed[cid] / total), 4)
+
+def schedule_categories(selected_ids, cat_stats):
+    # دسته‌های جامانده از اجرای قبل (بودجه زمانی) اول؛ بیشترین دفعات جاماندن و قدیمی‌ترین خزش جلوتر،
+    # تا همیشه همان دم صف حذف نشود. بقیه LPT: طولانی‌ترین دسته‌ها اول؛ دسته‌های بی‌سابقه قبل از همه
+    if not cat_stats:
+        return list(selected_ids)
+    stats_of = lambda cid: cat_stats.get(str(cid)) or {}
+    deferred = sorted((cid for cid in selected_ids if stats_of(cid).get('deferred')),
+                      key=lambda cid: (-stats_of(cid)['deferred'], stats_of(cid).get('last_ts', 0), cid))
+    rest = [cid for cid in selected_ids if not stats_of(cid).get('deferred')]
+    if CAT_SCHEDULE != "lpt":
+        return deferred + rest
+    def priority(cid):
+        st = stats_of(cid)
+        if st.get('duration') is None:
+            return float('inf')
+        return st['duration'] * (1 + CAT_CHANGE_PRIORITY * st.get('change_rate', 0))
+    return deferred + sorted(rest, key=lambda cid: (-priority(cid), cid))
+
+# ==============================================================================
+# برنامه‌ریز خزش بدون هم‌پوشانی (حذف لیست والدهایی که فرزندانشان پوشش می‌دهند)
+# ==============================================================================
+CRAWL_PLANNER = os.environ.get("CRAWL_PLANNER", "true").lower() == "true"
+CRAWL_PLANNER_MIN_RUNS = int(os.environ.get("CRAWL_PLANNER_MIN_RUNS", "2"))
+CRAWL_PLANNER_VERIFY_EVERY = int(os.environ.get("CRAWL_PLANNER_VERIFY_EVERY", "12"))
+
+def plan_category_crawl(selected_ids, cat_stats):
+    # والد وقتی حذف می‌شود که همه فرزندان مستقیمش در همین خزش باشند و در چند اجرای اخیر
+    # هیچ محصولی به خود والد (به‌عنوان leaf) نرسیده باشد. اگر فرزندی خالی یا ناقص برگردد، والد در همان
+    # اجرا خزیده می‌شود (scrape_categories_products)؛ راستی‌آزمایی هر چند اجرا فقط پشتوانه است.
+    selected = set(selected_ids)
+    children = defaultdict(set)
+    for cid, parent in CATEGORY_PARENT.items():
+        if parent:
+            children[parent].add(cid)
+    crawl, skipped = [], []
+    for cid in selected_ids:
+        st = cat_stats.get(str(cid)) or {}
+        kids = children.get(cid)
+        redundant = (
+            kids and kids <= selected
+            and st.get('own_zero_runs', 0) >= CRAWL_PLANNER_MIN_RUNS
+            and st.get('skipped_runs', 0) < CRAWL_PLANNER_VERIFY_EVERY
+        )
+        if redundant:
+            skipped.append(cid)
+            cat_stats.setdefault(str(cid), {})['skipped_runs'] = st.get('skipped_runs', 0) + 1
+        else:
+            crawl.append(cid)
+            if str(cid) in cat_stats:
+                cat_stats[str(cid)]['skipped_runs'] = 0
+    if skipped:
+        logger.info(f"✂️ برنامه‌ریز خزش: {len(skipped)} لیست والد تکراری حذف شد: {[cat_label(c) for c in skipped]}")
+    return crawl, skipped
+
+def record_category_own_counts(cat_stats, canonical_products, crawled_ids):
+    own = Counter(p.get('category_id') for p in canonical_products.values())
+    for cid in crawled_ids:
+        st = cat_stats.get(str(cid))
+        if st is None:
+            continue
+        st['own_count'] = own.get(cid, 0)
+        st['own_zero_runs'] = st.get('own_zero_runs', 0) + 1 if st['own_count'] == 0 else 0
+
+# ==============================================================================
+# اثر انگشت صفحه اول دسته: دسته بدون تغییر خزیده نمی‌شود و محصولات کش دوباره استفاده می‌شوند
+# ==============================================================================
+CAT_FINGERPRINT = os.environ.get("CAT_FINGERPRINT", "true").lower() == "true"
+CAT_FINGERPRINT_FULL_EVERY = int(os.environ.get("CAT_FINGERPRINT_FULL_EVERY", "6"))
+FINGERPRINT_REUSE_FIELDS = ('id', 'name', 'category_id', 'detail_hint_cat_id', 'price', 'image')
+
+def known_category_fingerprint(st, cached_products):
+    # فقط وقتی همه محصولات خزش کامل قبلی هنوز در کش و موجودند؛ هر CAT_FINGERPRINT_FULL_EVERY اجرا یک خزش کامل
+    if not CAT_FINGERPRINT or cached_products is None or not st or not st.get('fingerprint'):
+        return None
+    if st.get('fingerprint_hits', 0) >= CAT_FINGERPRINT_FULL_EVERY:
+        return None
+    for pid in st.get('fingerprint_pids') or ():
+        old = cached_products.get(pid)
+        if not old or int(old.get('stock', 0) or 0) <= 0:
+            return None
+    return st['fingerprint']
+
+def reuse_category_products(st, first_page, cached_products):
+    products = list(first_page)
+    seen = {p['id'] for p in products}
+    for pid in st.get('fingerprint_pids') or ():
+        if pid in seen:
+            continue
+        old = cached_products[pid]
+        products.append(dict({k: old[k] for k in FINGERPRINT_REUSE_FIELDS if k in old}, stock=1, specs={}))
+    return products
 
-    cached_products_raw = load_cache()
-    cached_products = normalize_cache(cached_products_raw, all_cats)
+def record_category_fingerprint(cat_stats, cat_id, crawl_info, products_in_cat):
+    st = cat_stats.setdefault(str(cat_id), {})
+    if crawl_info.get('unchanged'):
+        st['fingerprint_hits'] = st.get('fingerprint_hits', 0) + 1
+    elif crawl_info.get('complete', True) and crawl_info.get('fingerprint'):
+        st['fingerprint'] = crawl_info['fingerprint']
+        st['fingerprint_pids'] = sorted({str(p['id']) for p in products_in_cat})
+        st['fingerprint_hits'] = 0
+    else:
+        for key in ('fingerprint', 'fingerprint_pids', 'fingerprint_hits'):
+            st.pop(key, None)
 
-    selected_ids = [cat['id'] for cat in scrape_categories]
+def scrape_categories_products(session, selected_ids, cat_stats=None, incomplete=None, cached_products=None,
+                               cancel=None):
+    # cached_products (اختیاری، کلید pid) اثر انگشت دسته‌ها را فعال می‌کند؛ حالت تیک آن را نمی‌دهد
+    # cancel (Event اختیاری): با خطای مرحله‌ای دیگر، دسته جدیدی خزیده نمی‌شود
     all_products = {}
     all_lock = Lock()
     cat_queue = Queue()
+    skipped_parents = set()
+    if cat_stats is not None:
+        if CRAWL_PLANNER:
+            selected_ids, skipped = plan_category_crawl(selected_ids, cat_stats)
+            skipped_parents = set(skipped)
+        selected_ids = schedule_categories(selected_ids, cat_stats)
     for cid in selected_ids:
         cat_queue.put(cid)
 
     shared = {'delay': 0.5}
     delay_lock = Lock()
     min_delay, max_delay = 0.2, 2.0
-    num_cat_workers = 3
 
     logger.info("\n⏳ شروع جمع‌آوری محصولات (Light)...")
     pbar = tqdm(total=len(selected_ids), desc="دریافت محصولات دسته‌ها")
     pbar_lock = Lock()
+    progress = {'done': 0}
+
+    def crawl_skipped_parent(cat_id):
+        # فرزند خالی یا ناقص برگشت: والدی که برنامه‌ریز حذف کرده بود در همین اجرا خزیده می‌شود
+        parent = CATEGORY_PARENT.get(cat_id)
+        with all_lock:
+            if parent not in skipped_parents:
+                return
+            skipped_parents.discard(parent)
+            cat_stats.setdefault(str(parent), {})['skipped_runs'] = 0
+        logger.info(f"↩️ {cat_label(cat_id)} خالی/ناقص بود؛ والد {cat_label(parent)} هم خزیده می‌شود.")
+        with pbar_lock:
+            pbar.total += 1
+            pbar.refresh()
+        cat_queue.put(parent)
 
     def cat_worker():
         while True:
@@ -1048,18 +2574,59 @@ def main():
                 cat_id = cat_queue.get_nowait()
             except Exception:
                 break
+            if past_deadline(RUN_SCRAPE_RESERVE_SEC) or (cancel is not None and cancel.is_set()):
+                # دسته خزیده‌نشده ناقص حساب می‌شود تا محصولاتش ناموجود نشوند
+                with all_lock:
+                    progress['deferred'] = progress.get('deferred', 0) + 1
+                    if incomplete is not None:
+                        incomplete.add(cat_id)
+                    if cat_stats is not None:
+                        record_category_deferred(cat_stats, cat_id)
+                with pbar_lock:
+                    pbar.update(1)
+                cat_queue.task_done()
+                continue
             with delay_lock:
                 d = shared['delay']
             try:
-                products_in_cat = get_products_from_category_page(session, cat_id, 10, d)
+                started = time.monotonic()
+                crawl_info = {}
+                with all_lock:
+                    st = dict(cat_stats.get(str(cat_id)) or {}) if cat_stats is not None else None
+                known = known_category_fingerprint(st, cached_products)
+                products_in_cat = get_products_from_category_page(session, cat_id, 10, d, crawl_info=crawl_info,
+                                                                  known_fingerprint=known)
+                if crawl_info.get('unchanged'):
+                    products_in_cat = reuse_category_products(st, products_in_cat, cached_products)
+                elapsed = time.monotonic() - started
                 with all_lock:
+                    if incomplete is not None and not crawl_info.get('complete', True):
+                        incomplete.add(cat_id)
                     for product in products_in_cat:
                         key = f"{product['id']}|{product['category_id']}"
                         all_products[key] = product
+                    if cat_stats is not None:
+                        cat_stats.setdefault(str(cat_id), {}).pop('deferred', None)
+                        # زمان خزش کوتاه‌شده در زمان‌بندی LPT حساب نمی‌شود
+                        if not crawl_info.get('unchanged'):
+                            record_category_crawl(cat_stats, cat_id, elapsed, len(products_in_cat))
+                        record_category_fingerprint(cat_stats, cat_id, crawl_info, products_in_cat)
+                    progress['done'] += 1
+                    done = progress['done']
+                    if crawl_info.get('unchanged'):
+                        progress['unchanged'] = progress.get('unchanged', 0) + 1
+                reused = " (بدون تغییر، از کش)" if crawl_info.get('unchanged') else ""
+                logger.info(f"📥 [{done}/{pbar.total}] {cat_label(cat_id)}: {len(products_in_cat)} محصول در {elapsed:.1f} ثانیه{reused}")
+                if not products_in_cat or not crawl_info.get('complete', True):
+                    crawl_skipped_parent(cat_id)
                 with delay_lock:
                     shared['delay'] = max(min_delay, shared['delay'] - 0.05) if len(products_in_cat) > 0 else min(max_delay, shared['delay'] + 0.1)
             except Exception as e:
                 logger.warning(f"⚠️ خطا در دسته {cat_label(cat_id)}: {e}")
+                if incomplete is not None:
+                    with all_lock:
+                        incomplete.add(cat_id)
+                crawl_skipped_parent(cat_id)
                 with delay_lock:
                     shared['delay'] = min(max_delay, shared['delay'] + 0.2)
             finally:
@@ -1068,7 +2635,7 @@ def main():
                 cat_queue.task_done()
 
     threads = []
-    for _ in range(num_cat_workers):
+    for _ in range(max(1, CAT_WORKERS)):
         t = Thread(target=cat_worker, daemon=True)
         t.start()
         threads.append(t)
@@ -1077,10 +2644,821 @@ def main():
     pbar.close()
 
     logger.info(f"✅ استخراج محصولات تمام شد. (کل کلیدهای id|leaf: {len(all_products)})")
+    if progress.get('deferred'):
+        reason = "لغو اسکرپ" if cancel is not None and cancel.is_set() else "بودجه زمانی اجرا"
+        logger.warning(f"⏳ {reason}: {progress['deferred']} دسته در این اجرا خزیده نشد.")
+    if progress.get('unchanged'):
+        logger.info(f"🧬 {progress['unchanged']} دسته با اثر انگشت بدون تغییر فقط تا صفحه اول خزیده شد.")
+    logger.info(f"⏱️ {LIST_LATENCY.summary()}")
+    return all_products
+
+# ==============================================================================
+# شاردینگ: تقسیم دسته‌ها بین چند پروسس/رانر و ادغام نهایی
+# ==============================================================================
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", "1")))
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+SHARD_MAX_AGE_SEC = int(os.environ.get("SHARD_MAX_AGE_SEC", "3600"))
+
+def shard_category_ids(category_ids, shard_index, shard_count):
+    # تقسیم قطعی: همه شاردها با یک لیست دسته به یک تقسیم‌بندی می‌رسند
+    ordered = sorted(set(category_ids))
+    return ordered[shard_index::shard_count]
+
+def shard_file_path(shard_index):
+    return os.path.join(SHARD_DIR, f"shard_{shard_index}.json")
+
+def write_shard_snapshot(shard_index, shard_count, category_ids, all_products, incomplete=(), cat_stats=None):
+    # آمار دسته‌های همین شارد داخل اسنپ‌شات می‌رود و merge آن را در category_stats.json ادغام می‌کند
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    path = shard_file_path(shard_index)
+    snapshot = {
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'categories': list(category_ids),
+        'incomplete': sorted(incomplete),
+        'ts': int(time.time()),
+        'products': all_products,
+        'cat_stats': {str(cid): (cat_stats or {})[str(cid)] for cid in category_ids if str(cid) in (cat_stats or {})},
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.info(f"✅ اسنپ‌شات شارد {shard_index}/{shard_count} ذخیره شد: {path} (کلیدها: {len(all_products)})")
+
+def load_shard_snapshots(selected_ids, shard_count):
+    # complete فقط وقتی True است که همه شاردها حاضر، تازه و با تقسیم‌بندی فعلی منطبق باشند؛
+    # آمار دسته‌ها فقط از شاردهای تازه و منطبق برگردانده می‌شود
+    all_products = {}
+    incomplete = set()
+    shard_stats = {}
+    complete = True
+    now = time.time()
+    for idx in range(shard_count):
+        path = shard_file_path(idx)
+        expected = shard_category_ids(selected_ids, idx, shard_count)
+        if not os.path.exists(path):
+            logger.warning(f"⚠️ اسنپ‌شات شارد {idx} پیدا نشد: {path}")
+            complete = False
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snap = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ اسنپ‌شات شارد {idx} خوانده نشد: {e}")
+            complete = False
+            continue
+        fresh = True
+        if snap.get('shard_count') != shard_count or sorted(snap.get('categories') or []) != expected:
+            logger.warning(f"⚠️ تقسیم‌بندی شارد {idx} با انتخاب فعلی منطبق نیست؛ ادغام می‌شود ولی کامل حساب نمی‌شود.")
+            complete = fresh = False
+        if now - float(snap.get('ts') or 0) > SHARD_MAX_AGE_SEC:
+            logger.warning(f"⚠️ اسنپ‌شات شارد {idx} قدیمی است؛ کامل حساب نمی‌شود.")
+            complete = fresh = False
+        if fresh:
+            shard_stats.update(snap.get('cat_stats') or {})
+        all_products.update(snap.get('products') or {})
+        incomplete.update(snap.get('incomplete') or [])
+    logger.info(f"✅ ادغام {shard_count} شارد: کلیدهای id|leaf={len(all_products)} | کامل={complete} | "
+                f"دسته‌های ناقص={len(incomplete)}")
+    return all_products, complete, incomplete, shard_stats
+
+def run_shard():
+    if not 0 <= SHARD_INDEX < SHARD_COUNT:
+        logger.error(f"❌ SHARD_INDEX={SHARD_INDEX} خارج از بازه SHARD_COUNT={SHARD_COUNT} است.")
+        return
+    session = login_eways(EWAYS_USERNAME, EWAYS_PASSWORD)
+    if not session:
+        logger.error("❌ لاگین انجام نشد. پایان.")
+        return
+    selection = load_selection(session)
+    if not selection:
+        return
+    selected_ids = [cat['id'] for cat in selection['scrape_categories']]
+    my_ids = shard_category_ids(selected_ids, SHARD_INDEX, SHARD_COUNT)
+    logger.info(f"🧩 شارد {SHARD_INDEX}/{SHARD_COUNT}: {len(my_ids)} از {len(selected_ids)} دسته")
+    # category_stats.json فقط خوانده می‌شود؛ شاردهای هم‌زمان آن را بازنویسی نمی‌کنند
+    cat_stats = load_category_stats()
+    incomplete = set()
+    all_products = scrape_categories_products(session, my_ids, cat_stats, incomplete)
+    write_shard_snapshot(SHARD_INDEX, SHARD_COUNT, my_ids, all_products, incomplete, cat_stats)
+
+def run_merge():
+    session = login_eways(EWAYS_USERNAME, EWAYS_PASSWORD)
+    if not session:
+        logger.error("❌ لاگین انجام نشد. پایان.")
+        return
+    selection = load_selection(session)
+    if not selection:
+        return
+    stores = prepare_stores(selection['transfer_categories'])
+    if not stores:
+        logger.error("❌ نگاشت دسته‌بندی ووکامرس ساخته نشد.")
+        return
+    cached_products = normalize_cache(load_cache(), selection['all_cats'])
+    selected_ids = [cat['id'] for cat in selection['scrape_categories']]
+    all_products, complete, incomplete, shard_stats = load_shard_snapshots(selected_ids, SHARD_COUNT)
+    if not complete:
+        logger.warning("⚠️ همه شاردها کامل نیستند؛ مرحله ناموجودسازی این اجرا رد می‌شود.")
+    cat_stats = load_category_stats()
+    cat_stats.update(shard_stats)
+    sync_products(session, selection, None, cached_products, all_products,
+                  allow_outofstock=complete, cat_stats=cat_stats, incomplete_categories=incomplete, stores=stores)
+    save_category_stats(cat_stats)
+
+# ==============================================================================
+# فید تغییرات (append-only، خواندن با cursor = آفست بایتی)
+# ==============================================================================
+CHANGE_FEED_FILE = os.environ.get("CHANGE_FEED_FILE", "change_feed.jsonl")  # خالی = خاموش
+CHANGE_FEED_READ_LIMIT = int(os.environ.get("CHANGE_FEED_READ_LIMIT", "1000"))
+# بیش از این اندازه، قدیمی‌ترین نیمه فید دور ریخته می‌شود (0 = بدون چرخش)
+CHANGE_FEED_MAX_BYTES = int(os.environ.get("CHANGE_FEED_MAX_BYTES", str(64 * 1024 * 1024)))
+CHANGE_FEED_LOCK = Lock()
+
+def change_events(cached_products, canonical_products, vanished_pids=(), pids=None):
+    # همان مقایسه light_changed، با نوع هر تغییر؛ pids (اختیاری) نتیجه diff_catalogs است تا همه کاتالوگ پیمایش نشود
+    events = []
+    for pid in (sorted(pids) if pids is not None else canonical_products):
+        p = canonical_products[pid]
+        old = cached_products.get(pid)
+        if not old:
+            events.append({"t": "created", "pid": pid, "price": p.get('price'),
+                           "stock": int(p.get('stock', 0)), "cat": p.get('category_id')})
+            continue
+        if str(old.get('price')) != str(p.get('price')):
+            events.append({"t": "price", "pid": pid, "old": old.get('price'), "new": p.get('price')})
+        if int(old.get('stock', 0)) != int(p.get('stock', 0)):
+            events.append({"t": "stock", "pid": pid, "old": int(old.get('stock', 0)), "new": int(p.get('stock', 0))})
+        if old.get('category_id') != p.get('category_id'):
+            events.append({"t": "category", "pid": pid, "old": old.get('category_id'), "new": p.get('category_id')})
+    for pid in sorted(vanished_pids):
+        events.append({"t": "oos", "pid": pid})
+    return events
+
+def append_change_events(events, source):
+    if not CHANGE_FEED_FILE or not events:
+        return
+    ts = int(time.time())
+    lines = "".join(json.dumps(dict(e, ts=ts, src=source), ensure_ascii=False, separators=(',', ':')) + "\n"
+                    for e in events)
+    # یک write برای کل اجرا تا خواننده هیچ‌وقت نیمی از رویدادهای یک اجرا را نبیند
+    with CHANGE_FEED_LOCK:
+        with open(CHANGE_FEED_FILE, 'a', encoding='utf-8') as f:
+            f.write(lines)
+        if CHANGE_FEED_MAX_BYTES and os.path.getsize(CHANGE_FEED_FILE) > CHANGE_FEED_MAX_BYTES:
+            rotate_change_feed()
+    counts = Counter(e['t'] for e in events)
+    logger.info(f"📰 فید تغییرات: {len(events)} رویداد {dict(counts)}")
+
+def _feed_header(f):
+    # فید چرخیده با خط {"feed_base": N} شروع می‌شود: N بایت قدیمی حذف شده و کرسرها مطلق می‌مانند
+    line = f.readline()
+    try:
+        base = json.loads(line).get("feed_base") if line.startswith(b'{"feed_base"') else None
+    except ValueError:
+        base = None
+    if base is None:
+        f.seek(0)
+        return 0, 0
+    return int(base), len(line)
+
+def rotate_change_feed():
+    with open(CHANGE_FEED_FILE, 'rb') as f:
+        base, start = _feed_header(f)
+        size = f.seek(0, os.SEEK_END)
+        # از مرز خط بعد از نقطه برش نگه داشته می‌شود
+        f.seek(max(start, size - CHANGE_FEED_MAX_BYTES // 2 - 1))
+        if f.tell() > start:
+            f.readline()
+        keep_from = f.tell()
+        rest = f.read()
+    new_base = base + keep_from - start
+    tmp_path = CHANGE_FEED_FILE + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps({"feed_base": new_base}).encode('utf-8') + b"\n")
+        f.write(rest)
+    # جایگزینی اتمیک؛ خواننده‌ای که فایل قبلی را باز کرده تا آخر همان را می‌خواند
+    os.replace(tmp_path, CHANGE_FEED_FILE)
+    logger.info(f"📰 فید تغییرات چرخید: {new_base - base} بایت قدیمی حذف شد (کرسر اول: {new_base})")
+
+def read_change_feed(cursor=0, limit=None):
+    if cursor < 0 or (limit is not None and limit < 0):
+        raise ValueError(f"cursor/limit منفی: {cursor}/{limit}")
+    limit = min(limit or CHANGE_FEED_READ_LIMIT, CHANGE_FEED_READ_LIMIT)
+    if not CHANGE_FEED_FILE or not os.path.exists(CHANGE_FEED_FILE):
+        if cursor:
+            raise ValueError(f"cursor بعد از انتهای فید: {cursor}")
+        return {"cursor": 0, "next": 0, "events": []}
+    events = []
+    with open(CHANGE_FEED_FILE, 'rb') as f:
+        base, start = _feed_header(f)
+        end = base + f.seek(0, os.SEEK_END) - start
+        if cursor > end:
+            raise ValueError(f"cursor بعد از انتهای فید: {cursor} > {end}")
+        # رویدادهای قبل از cursor چرخش حذف شده‌اند؛ خواننده از اولین رویداد موجود ادامه می‌دهد
+        reset = cursor < base
+        if reset:
+            cursor = base
+        if cursor > base:
+            f.seek(start + cursor - base - 1)
+            if f.read(1) != b"\n":
+                raise ValueError(f"cursor روی مرز رویداد نیست: {cursor}")
+        f.seek(start + cursor - base)
+        position = cursor
+        while len(events) < limit:
+            line = f.readline()
+            # خط ناقص (در حال نوشتن) خوانده نمی‌شود
+            if not line or not line.endswith(b"\n"):
+                break
+            position += len(line)
+            events.append(json.loads(line))
+    result = {"cursor": cursor, "next": position, "events": events}
+    if reset:
+        result["reset"] = True
+    return result
+
+def run_feed():
+    cursor = int(sys.argv[2]) if len(sys.argv) > 2 else int(os.environ.get("FEED_CURSOR", "0"))
+    limit = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    try:
+        print(json.dumps(read_change_feed(cursor, limit), ensure_ascii=False))
+    except ValueError as e:
+        logger.error(f"❌ خواندن فید تغییرات: {e}")
+        sys.exit(2)
+
+# ==============================================================================
+# تاریخچه قیمت/موجودی (فایل باینری append-only، فقط تغییرات)
+# ==============================================================================
+PRICE_HISTORY_FILE = os.environ.get("PRICE_HISTORY_FILE", "price_history.bin")  # خالی = خاموش
+PRICE_HISTORY_DAILY_AFTER_DAYS = int(os.environ.get("PRICE_HISTORY_DAILY_AFTER_DAYS", "30"))
+PRICE_HISTORY_RETENTION_DAYS = int(os.environ.get("PRICE_HISTORY_RETENTION_DAYS", "365"))
+PRICE_HISTORY_COMPACT_BYTES = int(os.environ.get("PRICE_HISTORY_COMPACT_BYTES", str(16 * 1024 * 1024)))
+# بعد از هر فشرده‌سازی، دفعه بعد فقط وقتی فایل این نسبت از اندازه فشرده‌شده بزرگ‌تر شده باشد
+PRICE_HISTORY_COMPACT_GROWTH = float(os.environ.get("PRICE_HISTORY_COMPACT_GROWTH", "0.25"))
+# هر رکورد 24 بایت: ts, pid, category, price (قیمت خام پنل), stock
+PRICE_HISTORY_RECORD = struct.Struct("<IIIqi")
+
+def _raw_price_int(value):
+    digits = re.sub(r'[^\d]', '', str(value or ''))
+    return int(digits) if digits else 0
+
+class PriceHistory:
+    def __init__(self, path=None):
+        self.path = path or PRICE_HISTORY_FILE
+        self.lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ts, self.pid, self.cat = array('I'), array('I'), array('I')
+        self.price, self.stock = array('q'), array('i')
+        # ایندکس هر محصول و هر دسته: جای رکوردها و زمانشان (به ترتیب زمان) برای bisect بدون key=
+        self.by_pid, self.pid_ts = defaultdict(list), defaultdict(lambda: array('I'))
+        self.by_cat, self.cat_ts = defaultdict(list), defaultdict(lambda: array('I'))
+        self.last = {}
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.ts)
+
+    def _add(self, rec):
+        ts, pid, cat, price, stock = rec
+        self.by_pid[pid].append(len(self.ts))
+        self.pid_ts[pid].append(ts)
+        self.by_cat[cat].append(len(self.ts))
+        self.cat_ts[cat].append(ts)
+        self.ts.append(ts)
+        self.pid.append(pid)
+        self.cat.append(cat)
+        self.price.append(price)
+        self.stock.append(stock)
+        self.last[pid] = (price, stock, cat)
+
+    def refresh(self):
+        # فقط بایت‌های جدید از آخرین آفست خوانده می‌شوند
+        with self.lock:
+            if not self.path or not os.path.exists(self.path):
+                return
+            size = os.path.getsize(self.path)
+            if size < self.offset:
+                self._reset()
+            size -= (size - self.offset) % PRICE_HISTORY_RECORD.size
+            if size <= self.offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+            for rec in PRICE_HISTORY_RECORD.iter_unpack(data):
+                self._add(rec)
+            self.offset = size
+
+    def record(self, products_by_pid, vanished_pids=(), ts=None):
+        if not self.path:
+            return 0
+        self.refresh()
+        ts = int(ts or time.time())
+        records = []
+        with self.lock:
+            for pid, p in products_by_pid.items():
+                if not str(pid).isdigit():
+                    continue
+                state = (_raw_price_int(p.get('price')), int(p.get('stock', 0) or 0), int(p.get('category_id') or 0))
+                if self.last.get(int(pid)) != state:
+                    records.append((ts, int(pid)) + (state[2], state[0], state[1]))
+            for pid in vanished_pids:
+                last = self.last.get(int(pid)) if str(pid).isdigit() else None
+                if last and last[1] != 0:
+                    records.append((ts, int(pid), last[2], last[0], 0))
+            if not records:
+                return 0
+            with open(self.path, 'ab') as f:
+                f.write(b"".join(PRICE_HISTORY_RECORD.pack(*rec) for rec in records))
+            for rec in records:
+                self._add(rec)
+            self.offset += len(records) * PRICE_HISTORY_RECORD.size
+        logger.info(f"📈 تاریخچه قیمت: {len(records)} تغییر ثبت شد (کل: {len(self)})")
+        return len(records)
+
+    def _row(self, i):
+        return {"ts": self.ts[i], "pid": str(self.pid[i]), "cat": self.cat[i],
+                "price": self.price[i], "stock": self.stock[i]}
+
+    def for_pid(self, pid, start=None, end=None):
+        self.refresh()
+        pid = int(pid)
+        return [self._row(i) for i in self._in_range(self.by_pid.get(pid, []), self.pid_ts.get(pid, ()), start, end)]
+
+    def for_category(self, cat_id, start=None, end=None, subtree=False):
+        # فقط رکوردهای همان دسته (یا دسته‌های زیرشاخه) از ایندکس دسته خوانده می‌شوند
+        self.refresh()
+        cats = [c for c in self.by_cat if in_category_subtrees(c, {cat_id})] if subtree else [cat_id]
+        positions = []
+        for c in cats:
+            positions.extend(self._in_range(self.by_cat.get(c, []), self.cat_ts.get(c, ()), start, end))
+        if len(cats) > 1:
+            positions.sort()
+        return [self._row(i) for i in positions]
+
+    @staticmethod
+    def _in_range(positions, times, start, end):
+        # رکوردها به ترتیب زمان نوشته می‌شوند؛ بازه زمانی با bisect روی زمان‌های همان ایندکس پیدا می‌شود
+        lo = 0 if start is None else bisect.bisect_left(times, start)
+        hi = len(positions) if end is None else bisect.bisect_right(times, end)
+        return positions[lo:hi]
+
+    def compact(self, now=None):
+        # جزئیات کامل برای DAILY_AFTER روز اخیر، سپس آخرین رکورد هر روز، و قبل از RETENTION فقط رکورد پایه هر محصول
+        self.refresh()
+        now = int(now or time.time())
+        daily_cutoff = now - PRICE_HISTORY_DAILY_AFTER_DAYS * 86400
+        retention_cutoff = now - PRICE_HISTORY_RETENTION_DAYS * 86400
+        with self.lock:
+            keep = []
+            for pid, positions in self.by_pid.items():
+                baseline = None
+                daily = {}
+                for i in positions:
+                    t = self.ts[i]
+                    if t < retention_cutoff:
+                        baseline = i
+                    elif t < daily_cutoff:
+                        daily[t // 86400] = i
+                    else:
+                        keep.append(i)
+                keep.extend(daily.values())
+                if baseline is not None:
+                    keep.append(baseline)
+            keep.sort()
+            before = len(self.ts)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(b"".join(PRICE_HISTORY_RECORD.pack(self.ts[i], self.pid[i], self.cat[i], self.price[i], self.stock[i])
+                                 for i in keep))
+            os.replace(tmp_path, self.path)
+            self._reset()
+        self.refresh()
+        # اندازه بعد از فشرده‌سازی کنار فایل می‌ماند تا اجراهای بعدی تا رشد کافی دوباره فشرده نکنند
+        with open(self.path + ".compacted", 'w', encoding='utf-8') as f:
+            f.write(str(self.offset))
+        logger.info(f"🗜️ فشرده‌سازی تاریخچه قیمت: {before} ← {len(self)} رکورد")
+
+    def compacted_size(self):
+        try:
+            with open(self.path + ".compacted", 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+_PRICE_HISTORY = None
+
+def price_history():
+    global _PRICE_HISTORY
+    if _PRICE_HISTORY is None:
+        _PRICE_HISTORY = PriceHistory()
+    return _PRICE_HISTORY
+
+def record_price_history(products_by_pid, vanished_pids=()):
+    if not PRICE_HISTORY_FILE:
+        return
+    history = price_history()
+    history.record(products_by_pid, vanished_pids)
+    if not os.path.exists(history.path):
+        return
+    size = os.path.getsize(history.path)
+    if size > PRICE_HISTORY_COMPACT_BYTES and size > history.compacted_size() * (1 + PRICE_HISTORY_COMPACT_GROWTH):
+        history.compact()
+
+def run_history():
+    # history pid <pid> [from] [to] | history category <id> [from] [to] | history compact
+    args = sys.argv[2:]
+    history = price_history()
+    if args[:1] == ["compact"]:
+        history.compact()
+        return
+    if len(args) < 2 or args[0] not in ("pid", "category"):
+        logger.error("❌ استفاده: history pid <pid> [from] [to] | history category <id> [from] [to] | history compact")
+        return
+    start = int(args[2]) if len(args) > 2 else None
+    end = int(args[3]) if len(args) > 3 else None
+    if args[0] == "pid":
+        rows = history.for_pid(args[1], start, end)
+    else:
+        rows = history.for_category(int(args[1]), start, end)
+    print(json.dumps(rows, ensure_ascii=False))
+
+# ==============================================================================
+# بنچمارک مقایسه کش و اسکرپ روی کاتالوگ مصنوعی
+# ==============================================================================
+BENCH_DIFF_SIZE = int(os.environ.get("BENCH_DIFF_SIZE", "200000"))
+
+def synthetic_catalogs(size, seed=0):
+    # کاتالوگ قبلی و فعلی با سهم کوچکی تغییر قیمت/دسته/مشخصات، حذف و محصول جدید
+    rng = random.Random(seed)
+    categories = list(range(20000, 20400))
+    old = {}
+    for i in range(size):
+        pid = str(100000 + i)
+        old[pid] = {'id': pid, 'name': f"P{pid}", 'price': str(rng.randrange(100000, 90000000)), 'stock': 1,
+                    'category_id': rng.choice(categories),
+                    'specs': {"رنگ": rng.choice(("مشکی", "سفید", "آبی")), "مدل": f"M{pid}"}}
+    new = {}
+    for pid, p in old.items():
+        r = rng.random()
+        if r < 0.005:
+            continue
+        p = dict(p)
+        if r < 0.025:
+            p['price'] = str(int(p['price']) + 1000)
+        elif r < 0.03:
+            p['category_id'] = rng.choice(categories)
+        elif r < 0.035:
+            p['specs'] = dict(p['specs'], گارانتی="18 ماهه")
+        new[pid] = p
+    for i in range(size // 100):
+        pid = str(100000 + size + i)
+        new[pid] = {'id': pid, 'name': f"P{pid}", 'price': "1000000", 'stock': 1,
+                    'category_id': categories[0], 'specs': {}}
+    return old, new
+
+def run_bench_diff():
+    old, new = synthetic_catalogs(BENCH_DIFF_SIZE)
+    enriched = [pid for pid in new if int(pid) % 50 == 0]
+    logger.info(f"🧪 بنچمارک diff: {len(old)} محصول قبلی، {len(new)} محصول فعلی، {len(enriched)} جزئیات تازه")
+
+    # مسیر قبلی sync: light قبل از جزئیات، full در plan_store، پیمایش کامل فید تغییرات و ناموجودها
+    t0 = time.perf_counter()
+    legacy_light = {pid for pid, p in new.items() if light_changed(old.get(pid), p)}
+    legacy_full = {pid for pid, p in new.items() if full_changed(old.get(pid), p)}
+    legacy_events = change_events(old, new)
+    legacy_removed = {pid for pid in old if pid not in new}
+    legacy_sec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    diff = diff_catalogs(old, new)
+    diff_sec = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    refresh_diff(diff, old, new, enriched)
+    events = change_events(old, new, pids=diff_light(diff))
+    rest_sec = time.perf_counter() - t0
+
+    same = (diff_light(diff) == legacy_light and diff_full(diff) == legacy_full
+            and diff['removed'] == legacy_removed and events == legacy_events)
+    logger.info(f"   - حلقه‌های قبلی (light + full + فید + حذف): {legacy_sec:.3f} ثانیه")
+    logger.info(f"   - diff یک‌جا: {diff_sec:.3f} ثانیه | به‌روزرسانی جزئیات + فید: {rest_sec:.3f} ثانیه | "
+                f"کل: {diff_sec + rest_sec:.3f} ثانیه ({legacy_sec / max(diff_sec + rest_sec, 1e-9):.1f}x)")
+    logger.info(f"   - جدید={len(diff['new'])} تغییر={len(diff['changed'])} مشخصات={len(diff['specs_changed'])} "
+                f"حذف={len(diff['removed'])} | {'✅ نتیجه یکسان با حلقه‌های قبلی' if same else '❌ نتیجه متفاوت'}")
 
-    canonical_products = condense_products_to_leaf(all_products, all_cats)
+# ==============================================================================
+# حالت تیک: فقط قیمت/موجودی از صفحات لیست ← آپدیت گروهی ووکامرس
+# ==============================================================================
+TICK_OUTOFSTOCK = os.environ.get("TICK_OUTOFSTOCK", "true").lower() == "true"
+
+def run_tick(target=None):
+    # تیک فقط فروشگاه اصلی را به‌روز می‌کند (آدرس، کلید، جدول قیمت و صف خروجی همان فروشگاه)
+    target = target or load_wc_targets()[0]
+    session = login_eways(EWAYS_USERNAME, EWAYS_PASSWORD)
+    if not session:
+        logger.error("❌ لاگین انجام نشد. پایان.")
+        return
+    selection = load_selection(session)
+    if not selection:
+        return
+    cached_products = normalize_cache(load_cache(), selection['all_cats'])
+    selected_ids = [cat['id'] for cat in selection['scrape_categories']]
+    incomplete = set()
+    all_products = scrape_categories_products(session, selected_ids, incomplete=incomplete)
+    canonical_products = condense_products_to_leaf(all_products, selection['all_cats'])
+
+    # محصولات بدون wc_id (جدیدها) و تغییر دسته/مشخصات به اجرای کامل واگذار می‌شوند
+    actions, changed_by_action = [], {}
+    for pid, p in canonical_products.items():
+        old = cached_products.get(pid)
+        if not old or not old.get('wc_id'):
+            continue
+        if str(old.get('price')) == str(p.get('price')) and int(old.get('stock', 0)) == int(p.get('stock', 0)):
+            continue
+        stock = int(p.get('stock', 0))
+        action = {"id": f"update:{pid}", "op": "update", "pid": pid, "wc_id": old['wc_id'], "payload": {
+            "regular_price": target.price(p.get('price', 0)),
+            "stock_quantity": stock,
+            "manage_stock": True,
+            "stock_status": "instock" if stock > 0 else "outofstock",
+        }}
+        actions.append(action)
+        changed_by_action[action['id']] = (pid, p.get('price'), stock)
+
+    if TICK_OUTOFSTOCK:
+        # فقط برای دسته‌هایی که در همین تیک محصول برگرداندند؛ خطای یک دسته باعث ناموجودسازی نمی‌شود
+        seen_cats = {p.get('category_id') for p in canonical_products.values()}
+        for pid, old in cached_products.items():
+            if pid in canonical_products or not old.get('wc_id') or int(old.get('stock', 0)) <= 0:
+                continue
+            if old.get('category_id') not in seen_cats or in_category_subtrees(old.get('category_id'), incomplete):
+                continue
+            action = outofstock_action(old['wc_id'])
+            actions.append(action)
+            changed_by_action[action['id']] = (pid, old.get('price'), 0)
+
+    logger.info(f"⚡️ {_store_tag(target)}تیک: {len(actions)} تغییر قیمت/موجودی برای ارسال")
+    if not actions:
+        return
+    stats = apply_sync_plan(new_plan(actions), target=target)
+    applied, vanished = {}, set()
+    for action_id in stats['done_ids']:
+        pid, price, stock = changed_by_action[action_id]
+        if action_id.startswith("outofstock:"):
+            vanished.add(pid)
+        else:
+            applied[pid] = dict(cached_products[pid], price=price, stock=stock)
+    append_change_events(change_events(cached_products, applied, vanished), "tick")
+    record_price_history(applied, vanished)
+    for action_id in stats['done_ids']:
+        pid, price, stock = changed_by_action[action_id]
+        cached_products[pid]['price'] = price
+        cached_products[pid]['stock'] = stock
+    if stats['done_ids']:
+        save_cache(cached_products)
+    logger.info(f"⚡️ تیک تمام شد: آپدیت={stats['updated'] + stats['outofstock_updated']} | شکست={stats['failed']}")
+
+# ==============================================================================
+# بازقیمت‌گذاری کل کاتالوگ از قیمت‌های خام کش (بدون اسکرپ)
+# ==============================================================================
+def reprice_target(target, cached_products):
+    tag = _store_tag(target)
+    wc_index = WcProductIndex(get_all_wc_products_with_prefixes(target=target))
+    actions, unmatched = [], 0
+    for pid, p in cached_products.items():
+        entry = wc_index.get(pid)
+        if not entry:
+            unmatched += 1
+            continue
+        new_price = target.price(p.get('price', 0))
+        if str(entry.get('regular_price') or '') == new_price:
+            continue
+        actions.append({"id": f"update:{pid}", "op": "update", "pid": pid, "wc_id": entry['id'],
+                        "payload": {"regular_price": new_price}})
+    logger.info(f"💲 {tag}بازقیمت‌گذاری: {len(actions)} قیمت تغییرکرده از {len(cached_products)} محصول کش"
+                f" (بدون محصول ووکامرس: {unmatched})")
+    if not actions:
+        return None
+    stats = apply_sync_plan(new_plan(actions), target=target)
+    logger.info(f"💲 {tag}بازقیمت‌گذاری تمام شد: آپدیت={stats['updated']} | شکست={stats['failed']}")
+    return stats
+
+def run_reprice():
+    cached_products = load_cache()
+    if not cached_products or any('|' in k for k in cached_products):
+        logger.error("❌ کش محصولات (با کلید pid) موجود نیست؛ ابتدا یک اجرای کامل sync لازم است.")
+        return
+    run_per_target(load_wc_targets(), lambda target: reprice_target(target, cached_products))
+
+# ==============================================================================
+# گراف وابستگی مراحل راه‌اندازی (گره‌های مستقل هم‌زمان اجرا می‌شوند)
+# ==============================================================================
+STARTUP_WORKERS = int(os.environ.get("STARTUP_WORKERS", "6"))
+
+def run_stage_graph(nodes, workers=None, cancel=None):
+    # nodes: {name: (deps, fn)}؛ fn دیکشنری نتایج گره‌های قبلی را می‌گیرد. با خطای یک گره، وابسته‌هایش اجرا نمی‌شوند
+    # و cancel (Event اختیاری) خبر می‌دهد تا مراحل در حال اجرا (مثل اسکرپ) زودتر تمام شوند
+    results, timings, failed = {}, {}, {}
+    pending = dict(nodes)
+    running = {}
+    if PROFILE_STAGES:
+        # پروفایلر و tracemalloc سراسری‌اند؛ مراحل هم‌زمان آمار هم را آلوده می‌کنند
+        workers = 1
+        logger.info("🔬 پروفایل فعال است؛ مراحل راه‌اندازی پشت‌سرهم اجرا می‌شوند.")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers or STARTUP_WORKERS, thread_name_prefix="stage") as pool:
+        while pending or running:
+            if not failed:
+                for name in [n for n, (deps, _) in pending.items() if all(d in results for d in deps)]:
+                    _, fn = pending.pop(name)
+                    running[pool.submit(_timed, fn, (dict(results),), {})] = name
+            if not running:
+                break
+            done, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    failed[name] = future.exception()
+                    logger.error(f"❌ مرحله {name}: {future.exception()}")
+                    if cancel is not None:
+                        cancel.set()
+                    continue
+                results[name], timings[name] = future.result()
+                logger.info(f"⏱️ مرحله {name}: {timings[name]:.1f} ثانیه")
+    wall = time.monotonic() - started
+    logger.info(f"⏱️ مراحل راه‌اندازی: {wall:.1f} ثانیه (اجرای پشت‌سرهم: {sum(timings.values()):.1f} ثانیه)")
+    if failed or pending:
+        raise RuntimeError(f"مراحل ناموفق: {', '.join(failed)}؛ اجرا نشده: {', '.join(pending)}")
+    return results
+
+def _required(value, message):
+    if not value:
+        raise RuntimeError(message)
+    return value
+
+# ==============================================================================
+# تابع اصلی
+# ==============================================================================
+def sync_state(cached_products, updated_cache, vanished_pids, events):
+    # تغییرات کش/فید/تاریخچه این اجرا نسبت به کش قبلی
+    return {
+        "products": {pid: base for pid, base in updated_cache.items() if cached_products.get(pid) != base},
+        "removed": sorted(cached_products.keys() - updated_cache.keys()),
+        "vanished": sorted(vanished_pids),
+        "events": events,
+    }
+
+def commit_sync_state(state, plan, done_ids, wc_ids=None, cached_products=None, source="sync"):
+    # محصولی که اقدامش (با pid یا wc_id) انجام نشده در کش به حالت قبل می‌ماند تا اجرای بعد دوباره آن را ببیند
+    if cached_products is None:
+        cached_products = load_cache()
+        if any('|' in k for k in cached_products):
+            logger.error("❌ کش قدیمی (کلید id|leaf) است؛ وضعیت پلن اعمال نشد. یک اجرای کامل sync لازم است.")
+            return cached_products
+    undone = set()
+    for action in plan['actions']:
+        if action['id'] not in done_ids:
+            undone |= _outbox_keys(action)
+
+    def committed(pid):
+        if f"pid:{pid}" in undone:
+            return False
+        wc_id = (state['products'].get(pid) or cached_products.get(pid) or {}).get('wc_id')
+        return not (wc_id and f"wc:{wc_id}" in undone)
+
+    cache = dict(cached_products)
+    applied = {}
+    for pid, base in state['products'].items():
+        if committed(pid):
+            cache[pid] = applied[pid] = base
+    for pid in state['removed']:
+        if committed(pid):
+            cache.pop(pid, None)
+    if wc_ids:
+        # شناسه محصولات تازه‌ساخته برای حالت تیک در کش نگه داشته می‌شود
+        for pid, base in applied.items():
+            wc_id = wc_ids.get(f"EWAYS-{pid}")
+            if wc_id:
+                base['wc_id'] = wc_id
+    held = len(state['products']) - len(applied)
+    if held:
+        logger.info(f"↩️ {held} محصول با اقدام ناموفق در کش به حالت قبل ماند.")
+    vanished = {pid for pid in state['vanished'] if committed(pid)}
+    save_cache(cache)
+    append_change_events([e for e in state['events'] if committed(e['pid'])], source)
+    record_price_history(applied, vanished)
+    return cache
+
+def prepare_stores(transfer_categories, targets=None, known_maps=None, wc_categories=None):
+    # نگاشت دسته‌ها برای هر فروشگاه به‌صورت هم‌زمان؛ فروشگاهی که نگاشتش ساخته نشود کنار می‌رود
+    targets = targets or load_wc_targets()
+    known_maps = known_maps or {}
+    wc_categories = wc_categories or {}
+
+    def build(target):
+        mapping = transfer_categories_to_wc(transfer_categories, known_map=known_maps.get(target.name), target=target,
+                                            wc_categories=wc_categories.get(target.name))
+        if not mapping:
+            raise RuntimeError("نگاشت دسته‌بندی ووکامرس ساخته نشد")
+        return mapping
+
+    mappings, _ = run_per_target(targets, build)
+    return [{"target": t, "category_mapping": mappings[t.name]} for t in targets if t.name in mappings]
+
+def diff_store(store, canonical_products):
+    target = store['target']
+    wc_products = store.get('wc_products')
+    if wc_products is None:
+        wc_products = get_all_wc_products_with_prefixes(SKU_PREFIXES, target=target)
+    wc_index = WcProductIndex(wc_products)
+    store['wc_index'] = wc_index
+    store['missing'] = wc_index.missing(canonical_products.keys())
+    store['mismatch'] = wc_index.category_mismatches(canonical_products, store['category_mapping'])
+    logger.info(f"🧭 {_store_tag(target)}موارد با دسته نامنطبق (Light): {len(store['mismatch'])}")
+    return store
+
+def store_drifted(target, entry, product):
+    # فروشگاه‌های غیر اصلی کش جدا ندارند؛ اختلاف قیمت/موجودی مستقیم با ایندکس همان فروشگاه سنجیده می‌شود
+    if not entry:
+        return False
+    instock = int(product.get('stock', 0) or 0) > 0
+    return (str(entry.get('regular_price') or '') != target.price(product.get('price', 0))
+            or (entry.get('stock_status') == 'instock') != instock)
+
+def plan_store(store, canonical_products, changed_pids, cat_map, protected_pids, allow_outofstock, primary):
+    target, wc_index, category_mapping = store['target'], store['wc_index'], store['category_mapping']
+    tag = _store_tag(target)
+    # دسته ممکن است بعد از دریافت جزئیات عمیق‌تر شده باشد؛ نامنطبق‌ها دوباره روی ایندکس حساب می‌شوند
+    mismatch_after = wc_index.category_mismatches(canonical_products, category_mapping)
+    to_send_items = {pid: p for pid, p in canonical_products.items()
+                     if pid in store['missing'] or pid in mismatch_after or pid in changed_pids
+                     or (not primary and store_drifted(target, wc_index.get(pid), p))}
+
+    send_counts = Counter(p['category_id'] for p in to_send_items.values())
+    logger.info(f"🛰️ {tag}اقلام ارسالی به ووکامرس به تفکیک دسته:")
+    for cid, cnt in sorted(send_counts.items(), key=lambda kv: (-kv[1], CATEGORY_NAME.get(kv[0], '') or '')):
+        logger.info(f"   - {cat_label(cid)}: {cnt}")
+
+    send_count = len(to_send_items)
+    logger.info(f"\n🚀 {tag}آماده‌سازی {send_count} قلم برای ووکامرس...")
+
+    # مدیریت ناموجودها
+    logger.info(f"\n⏳ {tag}مدیریت محصولات ناموجود...")
+    with profile_stage("outofstock"):
+        to_oos_ids = wc_index.outofstock_candidates(canonical_products.keys())
+        if protected_pids:
+            protected_ids = {wc_index.get(pid)['id'] for pid in protected_pids if wc_index.get(pid)}
+            if to_oos_ids & protected_ids:
+                logger.warning(f"⚠️ {tag}{len(to_oos_ids & protected_ids)} قلم از دسته‌های با خزش ناقص ناموجود نمی‌شوند.")
+            to_oos_ids -= protected_ids
+
+        if not allow_outofstock and to_oos_ids:
+            logger.warning(f"⚠️ {tag}اسکرپ کامل نیست؛ {len(to_oos_ids)} قلم ناموجود نمی‌شوند.")
+            to_oos_ids = set()
+        oos_actions = [outofstock_action(wc_id) for wc_id in sorted(to_oos_ids)]
+
+    alt_ids = {}
+    if ALT_SKU_LOOKUP:
+        unresolved = [pid for pid in to_send_items if not wc_index.get(pid)]
+        alt_ids = resolve_alt_skus(unresolved, target) if unresolved else {}
+
+    skipped = {}
+    actions = []
+    for p in to_send_items.values():
+        action = build_product_action(p, category_mapping, cat_map, wc_index, skipped, target, alt_ids)
+        if action:
+            actions.append(action)
+    actions.extend(oos_actions)
+    logger.info(f"📝 {tag}پلن: ساخت={sum(a['op'] == 'create' for a in actions)} | "
+                f"آپدیت={sum(a['op'] == 'update' for a in actions)} | ناموجود={len(to_oos_ids)} | "
+                f"رد (بدون دسته)={skipped.get('no_category', 0)} | رد (بدون جزئیات)={skipped.get('no_details', 0)}")
+    store['plan'] = new_plan(actions, skipped)
+    store['send_count'] = send_count
+    store['oos_count'] = len(to_oos_ids)
+
+def apply_store(store):
+    target, plan = store['target'], store['plan']
+    logger.info(f"\n🚧 {_store_tag(target)}اعمال گروهی {len(plan['actions'])} اقدام (شامل {store['oos_count']} ناموجود) ...")
+    stats = apply_sync_plan(plan, target=target)
+    log_apply_summary(stats, store['send_count'], target)
+    return stats
+
+def sync_products(session, selection, category_mapping, cached_products, all_products, allow_outofstock=True,
+                  cat_stats=None, wc_products=None, apply=True, incomplete_categories=None, stores=None):
+    # stores: لیست {"target", "category_mapping"[, "wc_products"]}؛ اولی فروشگاه اصلی است (wc_id کش از آن)
+    if stores is None:
+        stores = [{"target": DEFAULT_WC_TARGET, "category_mapping": category_mapping, "wc_products": wc_products}]
+    all_cats = selection['all_cats']
+    transfer_categories = selection['transfer_categories']
+
+    with profile_stage("condense"):
+        canonical_products = condense_products_to_leaf(all_products, all_cats)
     logger.info(f"🧭 محصولات (Light) پس از نگاشت به عمیق‌ترین زیرشاخه: {len(canonical_products)}")
-    print_products_tree_by_leaf(canonical_products, transfer_categories or all_cats)
+    if PRODUCTS_TREE_FILE:
+        dump_products_tree_by_leaf(canonical_products, transfer_categories or all_cats, PRODUCTS_TREE_FILE)
 
     cat_counts = Counter(p.get('category_id') for p in canonical_products.values())
     logger.info("📊 آمار تعداد محصولات به تفکیک دسته (leaf):")
@@ -1093,60 +3471,40 @@ def main():
     # مرحله تصمیم‌گیری برای جزئیات و ارسال
     # ============================
     logger.info("\n⛽️ بررسی گپ همگام‌سازی با ووکامرس (Light)...")
-    wc_products = get_all_wc_products_with_prefixes(SKU_PREFIXES)
-    wc_by_sku = {p.get('sku'): p for p in wc_products}
-    wc_skus = set(wc_by_sku.keys())
-
-    # ست SKUهایی که در WC تصویر ندارند (بدون GET اضافی)
-    wc_missing_image_skus = set()
-    for p in wc_products:
-        sku = p.get('sku') or ''
-        imgs = p.get('images') or []
-        if sku and len(imgs) == 0:
-            wc_missing_image_skus.add(sku)
-
-    changed_light = {}
-    for pid, p in canonical_products.items():
-        old = cached_products.get(pid)
-        if light_changed(old, p):
-            changed_light[pid] = p
-
-    def sku_candidates_for_pid(pid):
-        return [f"{pref}{pid}" for pref in SKU_PREFIXES]
-
-    missing_in_wc = {pid: p for pid, p in canonical_products.items() if not any(s in wc_skus for s in sku_candidates_for_pid(pid))}
-
-    mismatch_count = 0
-    mismatch = {}
-    for pid, p in canonical_products.items():
-        wcp = None
-        for s in sku_candidates_for_pid(pid):
-            wcp = wc_by_sku.get(s)
-            if wcp:
-                break
-        if not wcp:
-            continue
-        expected_wc_cat = category_mapping.get(p['category_id'])
-        wc_cat_ids = {c.get('id') for c in wcp.get('categories', []) if isinstance(c, dict)}
-        if expected_wc_cat and expected_wc_cat not in wc_cat_ids:
-            mismatch[pid] = p
-            mismatch_count += 1
-    logger.info(f"🧭 موارد با دسته نامنطبق (Light): {mismatch_count}")
-
-    need_details = set(changed_light.keys()) | set(missing_in_wc.keys()) | set(mismatch.keys())
-    for pid, p in canonical_products.items():
-        old = cached_products.get(pid)
-        if ALWAYS_DETAILS_FOR_NEW and not old:
-            need_details.add(pid)
-        elif not (old and old.get('specs')):
-            need_details.add(pid)
-        elif is_specs_stale(old):
-            need_details.add(pid)
+    primary_target = stores[0]['target'] if stores else None
+    with profile_stage("diff"):
+        diffed, _ = run_per_target([s['target'] for s in stores],
+                                   lambda t: diff_store(next(s for s in stores if s['target'] is t), canonical_products))
+        stores = [s for s in stores if s['target'].name in diffed]
+
+        catalog_diff = diff_catalogs(cached_products, canonical_products)
+        changed_light = diff_light(catalog_diff)
+    if cat_stats is not None:
+        crawled_ids = [c['id'] for c in selection['scrape_categories']
+                       if not (cat_stats.get(str(c['id'])) or {}).get('skipped_runs')
+                       and c['id'] not in (incomplete_categories or ())]
+        record_category_own_counts(cat_stats, canonical_products, crawled_ids)
+        if cached_products:
+            record_category_change_rates(cat_stats, canonical_products, changed_light)
+
+    # یک بار دریافت جزئیات برای نیاز همه فروشگاه‌ها
+    missing_in_wc = set().union(*(s['missing'] for s in stores))
+    mismatch = set().union(*(s['mismatch'] for s in stores))
+    need_details = build_detail_schedule(canonical_products, cached_products, missing_in_wc, mismatch, changed_light)
 
     logger.info(f"🔎 اقلام نیازمند دریافت جزئیات: {len(need_details)}")
     if need_details:
-        enrich_products_with_details(session, canonical_products, need_details)
+        with profile_stage("enrich"):
+            enrich_products_with_details(session, canonical_products, need_details)
 
+    # مشخصات و دسته عمیق‌تر فقط برای جزئیات‌گرفته‌ها عوض می‌شود؛ نتیجه برای همه فروشگاه‌ها مشترک است
+    refresh_diff(catalog_diff, cached_products, canonical_products, need_details)
+    changed_full = diff_full(catalog_diff)
+
+    primary = stores[0] if stores and stores[0]['target'] is primary_target else None
+    if primary is None:
+        logger.error("❌ فروشگاه اصلی در دسترس نیست؛ wc_id کش از اجرای قبل حفظ می‌شود.")
+    wc_index = primary['wc_index'] if primary else None
     updated_cache = {}
     for pid, p in canonical_products.items():
         base = dict(p)
@@ -1155,123 +3513,483 @@ def main():
             base['specs'] = old['specs']
             if old.get('details_ts'):
                 base['details_ts'] = old['details_ts']
+        entry = wc_index.get(pid) if wc_index else None
+        if entry:
+            base['wc_id'] = entry['id']
+        elif old and old.get('wc_id'):
+            base['wc_id'] = old['wc_id']
         updated_cache[pid] = base
 
-    save_cache(updated_cache)
+    # اسکرپ ناقص: محصولات دیده‌نشده را از کش حذف نکن تا اجرای بعد آن‌ها را جدید حساب نکند
+    protected_pids = set()
+    if incomplete_categories:
+        protected_pids = {pid for pid, old in cached_products.items()
+                          if pid not in canonical_products and in_category_subtrees(old.get('category_id'), incomplete_categories)}
+    for pid, old in cached_products.items():
+        if not allow_outofstock or pid in protected_pids:
+            updated_cache.setdefault(pid, old)
+
+    vanished_pids = set()
+    if allow_outofstock:
+        vanished_pids = {pid for pid in catalog_diff['removed']
+                         if pid not in protected_pids and int(cached_products[pid].get('stock', 0)) > 0}
+    state = sync_state(cached_products, updated_cache, vanished_pids,
+                       change_events(cached_products, canonical_products, vanished_pids, pids=diff_light(catalog_diff)))
 
     # ============================
-    # نهایی‌سازی اقلام ارسالی به ووکامرس
+    # نهایی‌سازی اقلام ارسالی به ووکامرس (برای هر فروشگاه)
     # ============================
-    to_send_items = {}
-    mismatch_count_after = 0
-    for pid, p in canonical_products.items():
-        old = cached_products.get(pid)
-        if full_changed(old, p):
-            to_send_items[pid] = p
-            continue
-        if not any(s in wc_skus for s in sku_candidates_for_pid(pid)):
-            to_send_items[pid] = p
-            continue
-        wcp = None
-        for s in sku_candidates_for_pid(pid):
-            wcp = wc_by_sku.get(s)
-            if wcp:
-                break
-        if wcp:
-            expected_wc_cat = category_mapping.get(p['category_id'])
-            wc_cat_ids = {c.get('id') for c in wcp.get('categories', []) if isinstance(c, dict)}
-            if expected_wc_cat and expected_wc_cat not in wc_cat_ids:
-                to_send_items[pid] = p
-                mismatch_count_after += 1
+    cat_map = {c['id']: c['name'] for c in (transfer_categories or all_cats)}
+    for store in stores:
+        plan_store(store, canonical_products, changed_full, cat_map, protected_pids, allow_outofstock,
+                   primary=store is primary)
+
+    # کش، فید و تاریخچه فقط بعد از اعمال (apply) و فقط برای اقدام‌های انجام‌شده نوشته می‌شوند؛ پلن وضعیت را با خود می‌برد
+    if primary:
+        primary['plan']['state'] = state
+    if not apply:
+        for store in stores:
+            save_plan(store['plan'], store['target'].plan_path)
+        return cached_products
+
+    with profile_stage("send"):
+        results, _ = run_per_target([s['target'] for s in stores],
+                                    lambda t: apply_store(next(s for s in stores if s['target'] is t)))
+
+    if primary is None:
+        logger.warning("⚠️ کش، فید و تاریخچه بدون فروشگاه اصلی به‌روز نمی‌شوند.")
+        return cached_products
+    stats = results.get(primary_target.name) or {}
+    with profile_stage("save_cache"):
+        return commit_sync_state(state, primary['plan'], stats.get('done_ids', set()), stats.get('wc_ids'),
+                                 cached_products)
+
+def main(apply=True):
+    targets = load_wc_targets()
+    cancel = threading.Event()
+
+    def scrape(r):
+        selected_ids = [cat['id'] for cat in r['categories']['scrape_categories']]
+        incomplete = set()
+        with profile_stage("scrape"):
+            all_products = scrape_categories_products(r['login'], selected_ids, r['cat_stats'], incomplete,
+                                                      cached_products=r['normalize'], cancel=cancel)
+        return all_products, incomplete
+
+    def categories(r):
+        with profile_stage("categories"):
+            return _required(load_selection(r['login']), "دسته‌بندی‌ها بارگذاری نشد")
+
+    # خواندن ووکامرس و کش به لاگین/اسکرپ eways وابسته نیست و هم‌زمان با آن انجام می‌شود
+    graph = {
+        'login': ((), lambda r: _required(login_eways(EWAYS_USERNAME, EWAYS_PASSWORD), "لاگین انجام نشد")),
+        'categories': (('login',), categories),
+        'cache': ((), lambda r: load_cache()),
+        'cat_stats': ((), lambda r: load_category_stats()),
+        'wc_categories': ((), lambda r: run_per_target(targets, get_wc_categories)[0]),
+        'wc_products': ((), lambda r: run_per_target(
+            targets, lambda t: get_all_wc_products_with_prefixes(SKU_PREFIXES, target=t))[0]),
+        'transfer': (('categories', 'wc_categories'), lambda r: _required(
+            prepare_stores(r['categories']['transfer_categories'], targets, wc_categories=r['wc_categories']),
+            "نگاشت دسته‌بندی ووکامرس ساخته نشد")),
+        'normalize': (('cache', 'categories'), lambda r: normalize_cache(r['cache'], r['categories']['all_cats'])),
+        'scrape': (('login', 'categories', 'cat_stats', 'normalize'), scrape),
+    }
+    try:
+        r = run_stage_graph(graph, cancel=cancel)
+    except RuntimeError as e:
+        logger.error(f"❌ {e}. پایان.")
+        return
 
-    send_counts = Counter(p['category_id'] for p in to_send_items.values())
-    logger.info("🛰️ اقلام ارسالی به ووکامرس به تفکیک دسته:")
-    for cid, cnt in sorted(send_counts.items(), key=lambda kv: (-kv[1], CATEGORY_NAME.get(kv[0], '') or '')):
-        logger.info(f"   - {cat_label(cid)}: {cnt}")
+    stores = r['transfer']
+    for store in stores:
+        store['wc_products'] = r['wc_products'].get(store['target'].name)
+    all_products, incomplete = r['scrape']
+    sync_products(r['login'], r['categories'], None, r['normalize'], all_products, cat_stats=r['cat_stats'],
+                  apply=apply, incomplete_categories=incomplete, stores=stores)
+    # حالت plan هیچ وضعیت ماندگاری نمی‌نویسد
+    if apply:
+        save_category_stats(r['cat_stats'])
 
-    send_count = len(to_send_items)
-    logger.info(f"\n🚀 شروع پردازش و ارسال {send_count} قلم به ووکامرس...")
+def run_plan():
+    main(apply=False)
 
-    # مدیریت ناموجودها
-    logger.info("\n⏳ مدیریت محصولات ناموجود...")
-    extracted_skus = set()
-    for pid in canonical_products.keys():
-        extracted_skus.update(sku_candidates_for_pid(pid))
-
-    to_oos_ids = set()
-    for pid in cached_products.keys():
-        pid_str = str(pid)
-        if not any(f"{pref}{pid_str}" in extracted_skus for pref in SKU_PREFIXES):
-            found_id = None
-            for s in sku_candidates_for_pid(pid_str):
-                wcp = wc_by_sku.get(s)
-                if wcp and wcp.get('stock_status') != "outofstock":
-                    found_id = wcp['id']; break
-            if found_id:
-                to_oos_ids.add(found_id)
-
-    for wcp in wc_products:
-        sku = wcp.get('sku')
-        if sku not in extracted_skus and wcp.get('stock_status') != "outofstock":
-            to_oos_ids.add(wcp['id'])
-
-    stats = {'created': 0, 'updated': 0, 'failed': 0, 'no_category': 0, 'outofstock_updated': 0, 'lock': Lock()}
-
-    product_queue = Queue()
-    for p in to_send_items.values():
-        product_queue.put(p)
+# ==============================================================================
+# سرویس جست‌وجوی کاتالوگ محلی (فقط‌خواندنی، بدون درخواست به ووکامرس)
+# ==============================================================================
+CATALOG_QUERY_LIMIT = int(os.environ.get("CATALOG_QUERY_LIMIT", "100"))
+CATALOG_RELOAD_SEC = float(os.environ.get("CATALOG_RELOAD_SEC", "10"))
+
+class CatalogIndex:
+    def __init__(self, products_by_pid, target=None):
+        # قیمت فروش با جدول قیمت فروشگاه اصلی (همان که wc_id کش از آن است)
+        target = target or DEFAULT_WC_TARGET
+        self.built_ts = time.time()
+        self.by_pid = {}
+        self.by_sku = {}
+        self.by_category = defaultdict(list)
+        by_price = []
+        for pid in sorted(products_by_pid):
+            p = products_by_pid[pid]
+            item = {
+                'pid': pid,
+                'sku': f"EWAYS-{pid}",
+                'wc_id': p.get('wc_id'),
+                'name': p.get('name'),
+                'category_id': p.get('category_id'),
+                'category': CATEGORY_NAME.get(p.get('category_id')),
+                'price': int(target.price(p.get('price', 0))),
+                'raw_price': p.get('price'),
+                'stock': int(p.get('stock', 0) or 0),
+                'image': p.get('image'),
+            }
+            self.by_pid[pid] = item
+            self.by_sku[item['sku']] = item
+            self.by_category[item['category_id']].append(item)
+            by_price.append((item['price'], pid))
+        by_price.sort()
+        self._prices = [price for price, _ in by_price]
+        self._price_pids = [pid for _, pid in by_price]
+
+    def __len__(self):
+        return len(self.by_pid)
+
+    def get(self, pid=None, sku=None):
+        if sku is not None:
+            return self.by_sku.get(sku)
+        return self.by_pid.get(str(pid))
+
+    def category(self, cat_id, subtree=False):
+        if not subtree:
+            return list(self.by_category.get(cat_id, ()))
+        # زیرشاخه‌ها از درخت دسته‌های بارگذاری‌شده (در حالت serve فقط leaf در دسترس است)
+        return [item for cid, items in self.by_category.items() if in_category_subtrees(cid, {cat_id}) for item in items]
+
+    def price_range(self, low=None, high=None):
+        lo = 0 if low is None else bisect.bisect_left(self._prices, low)
+        hi = len(self._prices) if high is None else bisect.bisect_right(self._prices, high)
+        return [self.by_pid[pid] for pid in self._price_pids[lo:hi]]
+
+    def stats(self):
+        return {'products': len(self), 'categories': len(self.by_category),
+                'in_stock': sum(1 for item in self.by_pid.values() if item['stock'] > 0),
+                'built': _utc_iso(self.built_ts)}
+
+def _query_int(query, key):
+    value = (query.get(key) or [None])[0]
+    return int(value) if value not in (None, "") else None
+
+def query_catalog(catalog, path, query):
+    # /catalog | /catalog/pid/<pid> | /catalog/sku/<sku> | /catalog/category/<id>?subtree=1 | /catalog/price?min=&max=&category=
+    parts = [p for p in path.split('/') if p][1:]
+    if not parts:
+        return 200, catalog.stats()
+    kind, arg = parts[0], (parts[1] if len(parts) > 1 else None)
+    if kind in ('pid', 'sku') and arg:
+        item = catalog.get(**{kind: arg})
+        return (200, item) if item else (404, {'error': 'not found'})
+    if kind == 'category' and arg and arg.isdigit():
+        items = catalog.category(int(arg), subtree=(query.get('subtree') or ['0'])[0] in ('1', 'true'))
+    elif kind == 'price':
+        items = catalog.price_range(_query_int(query, 'min'), _query_int(query, 'max'))
+        category = _query_int(query, 'category')
+        if category is not None:
+            items = [item for item in items if item['category_id'] == category]
+    else:
+        return 404, {'error': 'not found'}
+    if (query.get('in_stock') or ['0'])[0] in ('1', 'true'):
+        items = [item for item in items if item['stock'] > 0]
+    offset = _query_int(query, 'offset') or 0
+    limit = min(_query_int(query, 'limit') or CATALOG_QUERY_LIMIT, CATALOG_QUERY_LIMIT)
+    return 200, {'count': len(items), 'offset': offset, 'items': items[offset:offset + limit]}
+
+class CatalogFileState:
+    # برای حالت serve: ایندکس از فایل کش ساخته و با تغییر mtime دوباره ساخته می‌شود
+    def __init__(self, path=None, target=None):
+        self.path = path or CACHE_FILE
+        self.target = target
+        self.catalog = None
+        self.mtime = None
+        self.last_error = None
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            self.last_error = str(e)
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                products = normalize_cache(json.load(f), [])
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ بارگذاری کش برای سرویس کاتالوگ ناموفق: {e}")
+            self.last_error = str(e)
+            return False
+        self.catalog = CatalogIndex(products, self.target)
+        self.mtime = mtime
+        self.last_error = None
+        logger.info(f"📚 ایندکس کاتالوگ بازسازی شد: {len(self.catalog)} محصول")
+        return True
 
-    def worker_sender():
-        cat_map = {c['id']: c['name'] for c in (transfer_categories or all_cats)}
+    def watch(self):
         while True:
-            try:
-                product = product_queue.get_nowait()
-            except Exception:
-                break
-            process_product_wrapper((product, stats, category_mapping, cat_map, wc_by_sku, wc_missing_image_skus))
-            product_queue.task_done()
-
-    threads = []
-    for _ in range(WC_SENDER_WORKERS):
-        t = Thread(target=worker_sender)
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-
-    outofstock_queue = Queue()
-    for pid in to_oos_ids:
-        outofstock_queue.put(pid)
-    outofstock_count = len(to_oos_ids)
-    logger.info(f"\n🚧 آپدیت ناموجودها ({outofstock_count}) ...")
+            time.sleep(CATALOG_RELOAD_SEC)
+            self.reload_if_changed()
+
+    def health(self):
+        status = {'state': 'ok' if self.catalog is not None else 'starting', 'source': self.path,
+                  'last_error': self.last_error}
+        if self.catalog is not None:
+            status.update(self.catalog.stats())
+        return self.catalog is not None, status
+
+def run_serve():
+    state = CatalogFileState(target=load_wc_targets()[0])
+    state.reload_if_changed()
+    server = ThreadingHTTPServer((DAEMON_HEALTH_HOST, DAEMON_HEALTH_PORT), make_status_handler(state))
+    logger.info(f"📚 سرویس کاتالوگ روی {DAEMON_HEALTH_HOST}:{server.server_address[1]}")
+    Thread(target=state.watch, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("🛑 سرویس کاتالوگ متوقف شد.")
 
-    def outofstock_worker():
-        while True:
-            try:
-                product_id = outofstock_queue.get_nowait()
-            except Exception:
-                break
-            update_to_outofstock(product_id, stats)
-            if OUTOFSTOCK_SLEEP_SEC > 0:
-                time.sleep(random.uniform(0, OUTOFSTOCK_SLEEP_SEC))
-            outofstock_queue.task_done()
-
-    out_threads = []
-    for _ in range(WC_SENDER_WORKERS):
-        t = Thread(target=outofstock_worker)
-        t.start()
-        out_threads.append(t)
-    for t in out_threads:
-        t.join()
+# ==============================================================================
+# حالت دیمن: اجرای زمان‌بندی‌شده با وضعیت گرم در حافظه
+# ==============================================================================
+DAEMON_INTERVAL_MIN = float(os.environ.get("DAEMON_INTERVAL_MIN", "20"))
+DAEMON_CATEGORY_REFRESH_MIN = float(os.environ.get("DAEMON_CATEGORY_REFRESH_MIN", "60"))
+DAEMON_WC_FULL_REFRESH_CYCLES = int(os.environ.get("DAEMON_WC_FULL_REFRESH_CYCLES", "12"))
+# پیش‌فرض فقط محلی؛ /status و /changes احراز هویت ندارند، برای دسترسی بیرونی DAEMON_HEALTH_HOST=0.0.0.0 بگذارید
+DAEMON_HEALTH_HOST = os.environ.get("DAEMON_HEALTH_HOST", "127.0.0.1")
+DAEMON_HEALTH_PORT = int(os.environ.get("DAEMON_HEALTH_PORT", "8080"))
+
+def _utc_iso(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts))
+
+class DaemonState:
+    def __init__(self, target=None):
+        # دیمن فقط فروشگاه اصلی را همگام می‌کند
+        self.target = target or DEFAULT_WC_TARGET
+        self.session = None
+        self.selection = None
+        self.selection_ts = 0.0
+        self.category_mapping = {}
+        self.wc_products = {}
+        self.wc_synced_at = None
+        self.products = None
+        self.catalog = None
+        self.cat_stats = None
+        self.cycles = 0
+        self.run_lock = Lock()
+        self.status = {
+            'state': 'starting', 'cycles': 0, 'running': False,
+            'last_start': None, 'last_end': None, 'last_duration': None,
+            'last_success': None, 'last_error': None,
+        }
 
-    logger.info("\n===============================")
-    logger.info(f"📦 موجود (ارسال‌شده): {send_count}")
-    logger.info(f"🟢 ایجاد شده: {stats['created']}")
-    logger.info(f"🔵 آپدیت شده: {stats['updated']}")
-    logger.info(f"🟠 به ناموجود: {stats['outofstock_updated']}")
-    logger.info(f"🔴 شکست: {stats['failed']}")
-    logger.info(f"🟡 بدون دسته: {stats.get('no_category', 0)}")
-    logger.info("===============================\nتمام!")
+    def ensure_session(self, force=False):
+        # انقضای کوکی را خود کلاینت تشخیص می‌دهد؛ لاگین اجباری فقط بعد از چرخه ناموفق
+        if self.session is None:
+            self.session = login_eways(EWAYS_USERNAME, EWAYS_PASSWORD)
+        elif force and not self.session.login():
+            self.session = None
+        return self.session
+
+    def ensure_selection(self):
+        if self.selection is None or time.time() - self.selection_ts > DAEMON_CATEGORY_REFRESH_MIN * 60:
+            selection = load_selection(self.session)
+            if selection:
+                self.selection = selection
+                self.selection_ts = time.time()
+            elif self.selection:
+                logger.warning("⚠️ نوسازی دسته‌ها ناموفق بود؛ از درخت قبلی استفاده می‌شود.")
+        return self.selection
+
+    def ensure_category_mapping(self):
+        # فقط دسته‌های تازه منتقل می‌شوند؛ نگاشت قبلی دست‌نخورده می‌ماند
+        transfer = self.selection['transfer_categories']
+        if any(c['id'] not in self.category_mapping for c in transfer):
+            self.category_mapping = transfer_categories_to_wc(transfer, known_map=self.category_mapping,
+                                                              target=self.target)
+        return self.category_mapping
+
+    def refresh_wc_products(self):
+        started = time.time()
+        full = self.wc_synced_at is None or self.cycles % max(1, DAEMON_WC_FULL_REFRESH_CYCLES) == 0
+        if full:
+            self.wc_products = {p['id']: p for p in get_all_wc_products_with_prefixes(SKU_PREFIXES, target=self.target)}
+        else:
+            # یک دقیقه هم‌پوشانی برای جبران اختلاف ساعت سرور
+            changed = get_all_wc_products_with_prefixes(SKU_PREFIXES, modified_after=_utc_iso(self.wc_synced_at - 60),
+                                                        target=self.target)
+            for p in changed:
+                self.wc_products[p['id']] = p
+        self.wc_synced_at = started
+        return list(self.wc_products.values())
+
+    def run_cycle(self):
+        if not self.run_lock.acquire(blocking=False):
+            logger.warning("⚠️ چرخه قبلی هنوز در حال اجراست؛ این نوبت رد شد.")
+            return
+        started = time.time()
+        self.status.update({'running': True, 'last_start': int(started)})
+        # قفل فایل، هم‌پوشانی با اجرای sync/tick خارج از دیمن را هم می‌گیرد
+        if not acquire_run_lock("daemon"):
+            self.status.update({'running': False})
+            self.run_lock.release()
+            return
+        start_run_deadline()
+        try:
+            if not self.ensure_session(force=self.status['last_error'] is not None):
+                raise RuntimeError("لاگین انجام نشد")
+            if not self.ensure_selection():
+                raise RuntimeError("دسته‌بندی‌ها بارگذاری نشد")
+            category_mapping = self.ensure_category_mapping()
+            if not category_mapping:
+                raise RuntimeError("نگاشت دسته‌بندی ووکامرس ساخته نشد")
+            if self.products is None:
+                self.products = normalize_cache(load_cache(), self.selection['all_cats'])
+            if self.cat_stats is None:
+                self.cat_stats = load_category_stats()
+            selected_ids = [cat['id'] for cat in self.selection['scrape_categories']]
+            incomplete = set()
+            all_products = scrape_categories_products(self.session, selected_ids, self.cat_stats, incomplete,
+                                                      cached_products=self.products)
+            wc_products = self.refresh_wc_products()
+            stores = [{"target": self.target, "category_mapping": category_mapping, "wc_products": wc_products}]
+            self.products = sync_products(self.session, self.selection, category_mapping, self.products,
+                                          all_products, cat_stats=self.cat_stats, wc_products=wc_products,
+                                          incomplete_categories=incomplete, stores=stores)
+            self.catalog = CatalogIndex(self.products, self.target)
+            save_category_stats(self.cat_stats)
+            self.status.update({'state': 'ok', 'last_success': int(time.time()), 'last_error': None})
+        except Exception as e:
+            logger.error(f"❌ خطا در چرخه دیمن: {e}")
+            self.status.update({'state': 'error', 'last_error': str(e)})
+        finally:
+            self.cycles += 1
+            ended = time.time()
+            self.status.update({'running': False, 'cycles': self.cycles, 'last_end': int(ended),
+                                'last_duration': round(ended - started, 1)})
+            release_run_lock()
+            self.run_lock.release()
+
+    def health(self):
+        status = dict(self.status)
+        status.update({
+            'products': len(self.products or {}),
+            'wc_products': len(self.wc_products),
+            'categories': len((self.selection or {}).get('all_cats') or []),
+        })
+        last_ok = status.get('last_success')
+        healthy = bool(last_ok) and time.time() - last_ok < DAEMON_INTERVAL_MIN * 60 * 3
+        return (healthy or status['state'] == 'starting'), status
+
+def make_status_handler(state):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug("health: " + format % args)
+
+        def _send_json(self, code, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path in ("/", "/health", "/status"):
+                healthy, status = state.health()
+                return self._send_json(200 if healthy else 503, status)
+            if url.path == "/changes":
+                query = parse_qs(url.query)
+                try:
+                    return self._send_json(200, read_change_feed(_query_int(query, 'cursor') or 0, _query_int(query, 'limit')))
+                except ValueError:
+                    return self._send_json(400, {'error': 'bad request'})
+            if url.path.startswith("/history/"):
+                parts = [p for p in url.path.split('/') if p]
+                query = parse_qs(url.query)
+                try:
+                    if len(parts) != 3 or parts[1] not in ("pid", "category"):
+                        raise ValueError
+                    start, end = _query_int(query, 'from'), _query_int(query, 'to')
+                    if parts[1] == "pid":
+                        rows = price_history().for_pid(parts[2], start, end)
+                    else:
+                        rows = price_history().for_category(int(parts[2]), start, end,
+                                                            subtree=(query.get('subtree') or ['0'])[0] in ('1', 'true'))
+                except ValueError:
+                    return self._send_json(400, {'error': 'bad request'})
+                return self._send_json(200, {'count': len(rows), 'items': rows[-CATALOG_QUERY_LIMIT:]})
+            if url.path == "/catalog" or url.path.startswith("/catalog/"):
+                # ایندکس با جایگزینی کامل نو می‌شود؛ خواندن بدون قفل امن است
+                catalog = state.catalog
+                if catalog is None:
+                    return self._send_json(503, {'error': 'catalog not ready'})
+                try:
+                    code, payload = query_catalog(catalog, url.path, parse_qs(url.query))
+                except ValueError:
+                    code, payload = 400, {'error': 'bad request'}
+                return self._send_json(code, payload)
+            return self._send_json(404, {'error': 'not found'})
+    return StatusHandler
+
+def start_status_server(state):
+    server = ThreadingHTTPServer((DAEMON_HEALTH_HOST, DAEMON_HEALTH_PORT), make_status_handler(state))
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"🩺 سرور وضعیت روی {DAEMON_HEALTH_HOST}:{server.server_address[1]}")
+    return server
+
+def run_daemon():
+    # apscheduler فقط برای حالت دیمن لازم است؛ اجرای cron بدون آن هم کار می‌کند
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    state = DaemonState(load_wc_targets()[0])
+    if DAEMON_HEALTH_PORT:
+        start_status_server(state)
+    scheduler = BlockingScheduler()
+    scheduler.add_job(state.run_cycle, 'interval', minutes=DAEMON_INTERVAL_MIN,
+                      max_instances=1, coalesce=True, next_run_time=datetime.now())
+    logger.info(f"🕰️ دیمن شروع شد؛ هر {DAEMON_INTERVAL_MIN:g} دقیقه یک چرخه.")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("🛑 دیمن متوقف شد.")
+
+COMMANDS = {
+    "sync": main,
+    "shard": run_shard,
+    "merge": run_merge,
+    "tick": run_tick,
+    "plan": run_plan,
+    "apply": run_apply,
+    "reprice": run_reprice,
+    "serve": run_serve,
+    "feed": run_feed,
+    "history": run_history,
+    "bench-diff": run_bench_diff,
+    "daemon": run_daemon,
+}
+
+# حالت‌هایی که کش یا ووکامرس را می‌نویسند و نباید هم‌زمان اجرا شوند (دیمن قفل را در هر چرخه می‌گیرد).
+# shard عمداً آزاد است: شاردها برای اجرای هم‌زمان‌اند و فقط اسنپ‌شات خودشان را می‌نویسند؛ merge قفل دارد
+LOCKED_COMMANDS = {"sync", "merge", "tick", "plan", "apply", "reprice"}
 
 if __name__ == "__main__":
-    main()
+    mode = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("RUN_MODE", "sync")
+    if mode not in COMMANDS:
+        logger.error(f"❌ حالت ناشناخته: {mode} (مجاز: {', '.join(COMMANDS)})")
+        sys.exit(2)
+    if mode not in LOCKED_COMMANDS:
+        COMMANDS[mode]()
+    elif acquire_run_lock(mode):
+        start_run_deadline()
+        try:
+            COMMANDS[mode]()
+        finally:
+            release_run_lock()